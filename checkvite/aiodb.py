@@ -0,0 +1,147 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from checkvite import profiler
+
+
+# Runs the Database calls off the event loop. Writes are serialized on a
+# dedicated writer thread, reads run on a small pool of threads that each use
+# their own read-only SQLite connection.
+class AsyncDatabase:
+    def __init__(self, db, readers=4):
+        self.db = db
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix="checkvite-writer")
+        self.readers = ThreadPoolExecutor(
+            readers, thread_name_prefix="checkvite-reader"
+        )
+
+    async def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        profiled = profiler.current.get()
+        if profiled is not None:
+            call = profiled[0].in_thread(profiled[1], call)
+        return await loop.run_in_executor(executor, call)
+
+    async def read(self, func, *args, **kwargs):
+        return await self._run(self.readers, func, *args, **kwargs)
+
+    async def write(self, func, *args, **kwargs):
+        return await self._run(self.writer, func, *args, **kwargs)
+
+    @property
+    def size(self):
+        return self.db.size
+
+    @property
+    def version(self):
+        return self.db.stamp
+
+    @property
+    def listeners(self):
+        return self.db.listeners
+
+    @property
+    def counters(self):
+        return self.db.counters
+
+    @property
+    def thumbnails(self):
+        return self.db.thumbnails
+
+    @property
+    def codec(self):
+        return self.db.codec
+
+    @property
+    def data_dict(self):
+        return self.db.data_dict
+
+    @property
+    def store(self):
+        return self.db.data_dict.store
+
+    @property
+    def shared(self):
+        return self.db.shared
+
+    async def next_image_id(self):
+        # a write in shared mode, the sequence is stored
+        return await self.write(self.db.next_image_id)
+
+    # in memory but behind the database lock, which a resync holds for a
+    # while, so they are read off the loop too
+    async def get_user_stats(self, split, username):
+        return await self.read(self.db.get_user_stats, split, username)
+
+    async def get_rejection_stats(self):
+        return await self.read(self.db.get_rejection_stats)
+
+    async def get_entry(self, image_id):
+        return await self.read(self.db.__getitem__, image_id)
+
+    async def get_entries(self, image_ids):
+        return await self.read(self.db.get_entries, image_ids)
+
+    async def get_images(self, **kwargs):
+        return await self.read(lambda: list(self.db.get_images(**kwargs)))
+
+    async def prefetch(self, **kwargs):
+        return await self.read(self.db.prefetch, **kwargs)
+
+    async def get_image(self, **kwargs):
+        return await self.read(self.db.get_image, **kwargs)
+
+    async def get_feedback(self, image_ids):
+        return await self.read(self.db.get_feedback, image_ids)
+
+    async def set_feedback(self, image_id, feedback):
+        return await self.write(self.db.set_feedback, image_id, feedback)
+
+    async def add_image(self, **fields):
+        return await self.write(self.db.add_image, **fields)
+
+    async def update_image(self, image_id, **fields):
+        return await self.write(self.db.update_image, image_id, **fields)
+
+    async def update_images(self, updates):
+        return await self.write(self.db.update_images, updates)
+
+    def _save(self):
+        # on the writer thread, so no write sets `dirty` between the two
+        self.db.dirty = False
+        try:
+            self.db.save()
+        except BaseException:
+            self.db.dirty = True
+            raise
+
+    async def save(self):
+        await self.write(self._save)
+
+    async def sync(self):
+        # a failed save is retried on the next round, the journal keeps the
+        # changes meanwhile
+        while True:
+            await asyncio.sleep(self.db.data_dict.flush_interval)
+            if self.db.dirty:
+                try:
+                    await self.save()
+                except Exception as e:
+                    print(f"Saving failed, retrying: {e!r}")
+
+    async def watch(self, interval=0.2):
+        # picks up the changes committed by the other processes
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.write(self.db.sync_changes)
+            except Exception as e:
+                print(f"Reading the changes of the other workers failed: {e!r}")
+
+    async def close(self):
+        await self.save()
+        await self.write(self.db.save_snapshot)
+        self.writer.shutdown()
+        self.readers.shutdown()
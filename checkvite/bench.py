@@ -0,0 +1,620 @@
+import os
+import sys
+import argparse
+import asyncio
+import multiprocessing
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import time
+import statistics
+import urllib.error
+import urllib.request
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+from cryptography import fernet
+
+from checkvite.db import Database, TABS
+
+
+# started in the database directory by time_to_first_request()
+SERVER = """
+import sys
+from aiohttp import web
+from cryptography import fernet
+from checkvite import serve
+
+app = serve.create_app(secret_key=fernet.Fernet(fernet.Fernet.generate_key()))
+web.run_app(app, host="127.0.0.1", port=int(sys.argv[1]), print=None)
+"""
+
+USERS = ["admin", "user1", "user2", "user3", "user4", "user5"]
+REASONS = ["Offensive", "Not inclusive", "Wrong", "Too long", "Too short"]
+
+
+def synthetic_entries(size, seed=0):
+    rng = random.Random(seed)
+    for image_id in range(1, size + 1):
+        flag = rng.random()
+        need_training = int(flag < 0.2)
+        yield {
+            "dataset": "synthetic",
+            "image_id": image_id,
+            "image": f"images/{image_id}.png",
+            "alt_text": f"alt text {image_id}",
+            "license": "public domain",
+            "source": "",
+            "inclusive_alt_text": "",
+            "need_training": need_training,
+            "verified": int(0.2 <= flag < 0.5),
+            "rejection_reasons": rng.sample(REASONS, 1) if need_training else [],
+            "added_by": rng.choice(USERS) if flag > 0.99 else "admin",
+            "verified_by": "",
+            "modified_date": None,
+            "nsfw": 0,
+            "golden": 0,
+            "gpt_alt_text": "",
+        }
+
+
+def create_database(path, size, **kwargs):
+    db = Database(
+        filename=os.path.join(path, "alt-text"),
+        dataset_name=None,
+        image_dir=os.path.join(path, "images"),
+        **kwargs,
+    )
+    db.data_dict.load_items(synthetic_entries(size))
+    db.rebuild_index()
+    db.rebuild_counters()
+    return db
+
+
+def timed(func, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def bench_pages(db, rounds=20):
+    split_size = int(db.size * 0.2)
+    split = (split_size, 2 * split_size)
+    deep = max(0, split_size - 9)
+    scenarios = {
+        "check first page": dict(),
+        "check deep page": dict(start=max(0, db.size - 9)),
+        "user split first page": dict(split=split, username="user2"),
+        "user split deep page": dict(split=split, username="user2", start=deep),
+        "to_verify first page": dict(verified=0, need_training=0),
+        "to_verify user split": dict(
+            verified=0, need_training=0, split=split, username="user2"
+        ),
+    }
+    return {
+        name: timed(lambda: list(db.get_images(**kwargs)), rounds)
+        for name, kwargs in scenarios.items()
+    }
+
+
+def add_upload(db, rng=random):
+    return db.add_image(
+        dataset="bench",
+        image="",
+        alt_text="uploaded",
+        license="",
+        source="",
+        inclusive_alt_text="",
+        need_training=0,
+        verified=0,
+        added_by=rng.choice(USERS),
+        verified_by="",
+        nsfw=0,
+        golden=0,
+        gpt_alt_text="",
+    )
+
+
+def bench_adds(db, count, blocks=10):
+    # per-insert cost of add_image, block by block, it should stay flat
+    # as the database grows.
+    block = max(1, count // blocks)
+    timings = []
+    for _ in range(blocks):
+        start = time.perf_counter()
+        for _ in range(block):
+            add_upload(db)
+        timings.append((time.perf_counter() - start) / block * 1e6)
+    db.save()
+    return timings
+
+
+def add_annotators(count, password="bench"):
+    from checkvite import serve
+
+    names = [f"bench{i}" for i in range(count)]
+    for i, name in enumerate(names):
+        serve.users[name] = serve.User(
+            name,
+            {"password": serve.hash_password(password), "data_split": [i % 5, 0.2]},
+        )
+    return names
+
+
+async def annotate(server, username, rounds, password="bench"):
+    # one annotator session hitting /get_images and /train in a loop,
+    # returns the number of verdicts and the inconsistencies seen.
+    errors = []
+    verdicts = 0
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(cookie_jar=jar) as session:
+        await session.post(
+            server.make_url("/login"),
+            data={"username": username, "password": password},
+            allow_redirects=False,
+        )
+        for _ in range(rounds):
+            tab = random.choice(["to_verify", "verified", "to_train"])
+            async with session.get(
+                server.make_url("/get_images"), params={"tab": tab}
+            ) as resp:
+                images = await resp.json()
+            ids = [image["image_id"] for image in images]
+            if len(set(ids)) != len(ids) or ids != sorted(ids, reverse=True):
+                errors.append(f"{tab} page out of order: {ids}")
+            for image in images:
+                flags = (image["verified"], image["need_training"])
+                if flags != TABS[tab]:
+                    errors.append(f"{image['image_id']} {flags} in {tab}")
+            if not images:
+                continue
+            image = random.choice(images)
+            action = random.choice(["validate", "train"])
+            async with session.post(
+                server.make_url("/train"),
+                data={
+                    "image_id": str(image["image_id"]),
+                    "action": action,
+                    "caption": "",
+                    "rejection_reason": random.choice(REASONS),
+                },
+                allow_redirects=False,
+            ) as resp:
+                if resp.status != 302:
+                    errors.append(f"/train answered {resp.status}")
+            verdicts += 1
+    return verdicts, errors
+
+
+def consistency_errors(db):
+    # the in-memory indexes and counters must match the stored entries
+    errors = []
+    counters = db.counters
+    live = (counters.size, counters.verified, counters.need_training)
+    reasons = dict(counters.rejection_reasons)
+    tabs = {tab: list(index.ids) for tab, index in db.tabs.items()}
+    db.rebuild_index()
+    db.rebuild_counters()
+    if live != (db.size, db.verified, db.need_training):
+        errors.append(f"counters {live} != {(db.size, db.verified, db.need_training)}")
+    if reasons != db.get_rejection_stats():
+        errors.append("rejection counters differ from the store")
+    if tabs != {tab: index.ids for tab, index in db.tabs.items()}:
+        errors.append("tab indexes differ from the store")
+    return errors
+
+
+async def check_concurrency(size, annotators, rounds):
+    from checkvite import serve
+
+    with tempfile.TemporaryDirectory() as path:
+        db = create_database(path, size)
+        app = serve.create_app(
+            db, secret_key=fernet.Fernet(fernet.Fernet.generate_key())
+        )
+        names = add_annotators(annotators)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *[annotate(server, name, rounds) for name in names]
+            )
+            duration = time.perf_counter() - start
+        finally:
+            await server.close()
+
+        errors = [error for _, session_errors in results for error in session_errors]
+        verdicts = sum(count for count, _ in results)
+        errors.extend(consistency_errors(db))
+
+    print(
+        f"{annotators} annotators, {verdicts} verdicts in {duration:.2f}s "
+        f"({verdicts / duration:.0f}/s), {len(errors)} errors"
+    )
+    for error in errors[:20]:
+        print(f"  {error}")
+    return not errors
+
+
+def shared_worker(path, size, rounds, seed, barrier, results):
+    # one --workers process: verdicts and uploads through its own Database
+    # on the shared file, then a comparison of what it holds in memory with
+    # what the others committed
+    from checkvite.serve import StatsCache
+
+    db = Database(
+        filename=os.path.join(path, "alt-text"),
+        dataset_name=None,
+        image_dir=os.path.join(path, "images"),
+        lazy=True,
+        shared=True,
+    )
+    rng = random.Random(seed)
+    barrier.wait()
+    added = []
+    for i in range(rounds):
+        if rng.random() < 0.1:
+            added.append(int(add_upload(db, rng)))
+        elif rng.random() < 0.5:
+            db.update_image(
+                str(rng.randint(1, size)),
+                verified=1,
+                need_training=0,
+                rejection_reasons=[],
+            )
+        else:
+            db.update_image(
+                str(rng.randint(1, size)),
+                verified=0,
+                need_training=1,
+                rejection_reasons=[rng.choice(REASONS)],
+            )
+        if i % 10 == 0:
+            db.sync_changes()
+    db.save()
+    barrier.wait()
+    db.sync_changes()
+    # the same data must give the same /stats ETag in every worker
+    etag = StatsCache.etag(db.stamp, None)
+    errors = []
+    sample = [str(image_id) for image_id in rng.sample(range(1, size + 1), 50)]
+    stored = db.data_dict._select_entries(sample)
+    for key in sample:
+        flags = [
+            (entry["verified"], entry["need_training"])
+            for entry in (db[key], stored[key])
+        ]
+        if flags[0] != flags[1]:
+            errors.append(f"{key} is {flags[0]} in memory, {flags[1]} stored")
+    stored_keys = sorted(
+        key for key, in db.data_dict.cursor.execute("SELECT key FROM entries")
+    )
+    if sorted(db.data_dict.keys()) != stored_keys:
+        errors.append("keys differ from the store")
+    errors.extend(consistency_errors(db))
+    results.put((added, etag, [f"worker {seed}: {error}" for error in errors]))
+
+
+def check_workers(size, workers, rounds):
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as path:
+        create_database(path, size, shared=True).save()
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=shared_worker,
+                args=(path, size, rounds, seed, barrier, results),
+            )
+            for seed in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        duration = time.perf_counter() - start
+    added = [image_id for ids, _, _ in outcomes for image_id in ids]
+    errors = [error for _, _, worker_errors in outcomes for error in worker_errors]
+    if len(set(added)) != len(added):
+        errors.append("the same image id was handed out twice")
+    etags = {etag for _, etag, _ in outcomes}
+    if len(etags) != 1:
+        errors.append(f"the workers answer /stats with {len(etags)} different ETags")
+    print(
+        f"{workers} workers, {workers * rounds} writes in {duration:.2f}s, "
+        f"{len(added)} uploads, {len(errors)} errors"
+    )
+    for error in errors[:20]:
+        print(f"  {error}")
+    return not errors
+
+
+def random_verdict(rng):
+    if rng.random() < 0.5:
+        return {"verified": 1, "need_training": 0, "rejection_reasons": []}
+    return {
+        "verified": 0,
+        "need_training": 1,
+        "rejection_reasons": [rng.choice(REASONS)],
+    }
+
+
+def inject_failures(db):
+    # the commits of `db` that update an entry fail while the returned
+    # switch is on, the way a full disk would make them fail
+    cursor = db.data_dict.conn.cursor()
+    cursor.execute("CREATE TEMP TABLE failing (active INTEGER)")
+    cursor.execute("INSERT INTO failing VALUES (0)")
+    cursor.execute(
+        """
+        CREATE TEMP TRIGGER fail_updates BEFORE UPDATE ON entries
+        WHEN (SELECT active FROM failing)
+        BEGIN SELECT RAISE(ABORT, 'injected failure'); END
+    """
+    )
+    db.data_dict.conn.commit()
+
+    def switch(active):
+        cursor.execute("UPDATE failing SET active = ?", (int(active),))
+        db.data_dict.conn.commit()
+
+    return switch
+
+
+def stored_flags(db, keys):
+    stored = db.data_dict._select_entries(keys)
+    return {
+        key: (stored[key]["verified"], stored[key]["need_training"]) for key in keys
+    }
+
+
+def check_failures(size, rounds):
+    # every other bulk verdict fails to commit, nothing of it may stay in
+    # memory, and a verdict journaled while the commits fail is written by
+    # the next flush that succeeds
+    errors = []
+    failed = 0
+    for lazy in (False, True):
+        mode = "lazy" if lazy else "eager"
+        with tempfile.TemporaryDirectory() as path:
+            create_database(path, size).save()
+            db = Database(
+                filename=os.path.join(path, "alt-text"),
+                dataset_name=None,
+                image_dir=os.path.join(path, "images"),
+                lazy=lazy,
+            )
+            switch = inject_failures(db)
+            rng = random.Random(0)
+            for i in range(rounds):
+                batch = {
+                    image_id: random_verdict(rng)
+                    for image_id in rng.sample(range(1, size + 1), 9)
+                }
+                keys = [str(image_id) for image_id in batch]
+                held = {
+                    key: (db[key]["verified"], db[key]["need_training"]) for key in keys
+                }
+                counters = (db.verified, db.need_training)
+                switch(i % 2 == 0)
+                try:
+                    db.update_images(batch)
+                except sqlite3.Error:
+                    failed += 1
+                    if i % 2 == 1:
+                        errors.append(f"{mode}: batch {i} failed to commit")
+                    now = {
+                        key: (db[key]["verified"], db[key]["need_training"])
+                        for key in keys
+                    }
+                    if now != held or (db.verified, db.need_training) != counters:
+                        errors.append(f"{mode}: failed batch {i} stayed in memory")
+                else:
+                    if i % 2 == 0:
+                        errors.append(f"{mode}: batch {i} committed anyway")
+                if stored_flags(db, keys) != {
+                    key: (db[key]["verified"], db[key]["need_training"]) for key in keys
+                }:
+                    errors.append(f"{mode}: batch {i} differs from the store")
+
+            key = str(rng.randint(1, size))
+            switch(True)
+            db.update_image(key, verified=1, need_training=0, rejection_reasons=[])
+            try:
+                db.data_dict.flush()
+                errors.append(f"{mode}: the flush committed anyway")
+            except sqlite3.Error:
+                failed += 1
+            switch(False)
+            db.data_dict.flush()
+            if stored_flags(db, [key])[key] != (1, 0):
+                errors.append(f"{mode}: the verdict of a failed flush was lost")
+            errors.extend(f"{mode}: {error}" for error in consistency_errors(db))
+            db.data_dict.conn.close()
+
+    print(f"{2 * rounds} bulk verdicts, {failed} failed commits, {len(errors)} errors")
+    for error in errors[:20]:
+        print(f"  {error}")
+    return not errors
+
+
+def time_to_first_request(path, timeout=60):
+    # from the start of the interpreter to the first answered /stats, the
+    # server is stopped with Ctrl-C so it shuts down cleanly
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-c", SERVER, str(port)],
+        cwd=path,
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats"):
+                    return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        raise TimeoutError(f"no answer after {timeout}s")
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+
+def bench_startup(size):
+    # the first start rebuilds the index from the store, the clean shutdown
+    # writes the snapshot the second one starts from
+    with tempfile.TemporaryDirectory() as path:
+        create_database(path, size).save()
+        cold = time_to_first_request(path)
+        snapshot = os.path.exists(os.path.join(path, "alt-text.index"))
+        warm = time_to_first_request(path)
+    return cold, warm, snapshot
+
+
+def bench_prefetch(size, pages=100, amount=9):
+    # an annotator walking the to_verify tab of a cold lazy store, the time
+    # of the page fetches alone, without and with the next page prefetched
+    # between them as the server does in the background
+    scope = dict(verified=0, need_training=0, amount=amount)
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        create_database(path, size).save()
+        for prefetch in (False, True):
+            db = Database(
+                filename=os.path.join(path, "alt-text"),
+                dataset_name=None,
+                image_dir=os.path.join(path, "images"),
+                lazy=True,
+            )
+            after = None
+            timings = []
+            for _ in range(pages):
+                start = time.perf_counter()
+                images = list(db.get_images(after=after, **scope))
+                timings.append(time.perf_counter() - start)
+                if not images:
+                    break
+                after = images[-1]["image_id"]
+                if prefetch:
+                    db.prefetch(after=after, **scope)
+            results[prefetch] = statistics.median(timings) * 1000
+            db.data_dict.conn.close()
+    return results[False], results[True]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the page fetches.")
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=0,
+        help="Hammer /get_images and /train with that many annotators instead.",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Time the server start until the first answered request instead.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Write from that many processes sharing the database and check "
+        "they stay coherent instead.",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Time the page fetches of a cold lazy store with and without "
+        "the next page prefetched instead.",
+    )
+    parser.add_argument(
+        "--failures",
+        action="store_true",
+        help="Make every other bulk verdict fail to commit and check nothing "
+        "of it stays in memory instead.",
+    )
+    parser.add_argument(
+        "--adds",
+        type=int,
+        default=0,
+        help="Bulk-add that many images and report the per-insert cost instead.",
+    )
+    args = parser.parse_args()
+
+    if args.adds:
+        with tempfile.TemporaryDirectory() as path:
+            db = create_database(path, int(args.sizes.split(",")[0]))
+            first_id = db.data_dict.last_id + 1
+            timings = bench_adds(db, args.adds)
+            ids = sorted(int(key) for key in db.data_dict.keys())
+            ok = ids == list(range(1, first_id + args.adds))
+            ok = ok and db.size == len(ids) == db.index.ids[-1]
+        for i, timing in enumerate(timings):
+            print(f"block {i:>3}: {timing:8.1f} us/insert")
+        growth = timings[-1] / timings[0]
+        print(f"last/first block: {growth:.2f}, ids {'OK' if ok else 'BROKEN'}")
+        raise SystemExit(0 if ok and growth < 2 else 1)
+
+    if args.startup:
+        print(f"{'size':>8}{'cold (s)':>12}{'snapshot (s)':>14}")
+        ok = True
+        for size in [int(size) for size in args.sizes.split(",")]:
+            cold, warm, snapshot = bench_startup(size)
+            print(f"{size:>8}{cold:>12.3f}{warm:>14.3f}")
+            ok = ok and snapshot and warm < 1
+        raise SystemExit(0 if ok else 1)
+
+    if args.prefetch:
+        print(f"{'size':>8}{'cold (ms)':>12}{'prefetched (ms)':>17}")
+        for size in [int(size) for size in args.sizes.split(",")]:
+            cold, prefetched = bench_prefetch(size)
+            print(f"{size:>8}{cold:>12.3f}{prefetched:>17.3f}")
+        raise SystemExit(0)
+
+    if args.failures:
+        ok = check_failures(int(args.sizes.split(",")[0]), args.rounds)
+        raise SystemExit(0 if ok else 1)
+
+    if args.workers:
+        ok = check_workers(int(args.sizes.split(",")[0]), args.workers, args.rounds)
+        raise SystemExit(0 if ok else 1)
+
+    if args.concurrency:
+        sizes = [int(size) for size in args.sizes.split(",")]
+        ok = asyncio.run(check_concurrency(sizes[0], args.concurrency, args.rounds))
+        raise SystemExit(0 if ok else 1)
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as path:
+            db = create_database(path, size)
+            results[size] = bench_pages(db, args.rounds)
+
+    print(f"{'scenario (median ms)':<25}" + "".join(f"{size:>12}" for size in results))
+    for name in next(iter(results.values())):
+        print(
+            f"{name:<25}" + "".join(f"{results[size][name]:>12.3f}" for size in results)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,294 @@
 import os
-import asyncio
+import bisect
+import functools
+import hashlib
 import itertools
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
 import sqlite3
+import threading
 import time
 import json
 from datetime import datetime
-import pandas as pd
-
-from tqdm import tqdm
-from PIL import Image
-from datasets import load_dataset, Dataset, DatasetDict
-from datasets import (
-    load_dataset,
-    Dataset,
-    Features,
-    Value,
-    ClassLabel,
-    Image as DImage,
-    Sequence,
-)
+
+from checkvite.imagecodec import get_codec
+from checkvite.imagestore import ImageStore
+from checkvite.metrics import Histogram
+from checkvite.snapshot import read_snapshot, write_snapshot
+from checkvite.thumbnails import ThumbnailStore
 
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, pd.Timestamp):
+        # also takes pandas Timestamps, they are datetimes
+        if isinstance(obj, datetime):
             return obj.isoformat()
         return super().default(obj)
 
 
-features = Features(
-    {
-        "dataset": Value("string"),
-        "image_id": Value("int64"),
-        "image": DImage(),
-        "alt_text": Value("string"),
-        "license": Value("string"),
-        "source": Value("string"),
-        "inclusive_alt_text": Value("string"),
-        "need_training": ClassLabel(names=["no", "yes"]),
-        "verified": ClassLabel(names=["no", "yes"]),
-        "rejection_reasons": Sequence(Value("string")),
-        "added_by": Value("string"),
-        "verified_by": Value("string"),
-        "modified_date": Value("timestamp[ns]"),
-        "nsfw": ClassLabel(names=["no", "yes"]),
-        "golden": ClassLabel(names=["no", "yes"]),
-        "gpt_alt_text": Value("string"),
-    }
+# pandas, datasets, PIL and tqdm take seconds to import, they are imported
+# where they are used so the server starts without them
+@functools.cache
+def get_features():
+    from datasets import Features, Value, ClassLabel, Image as DImage, Sequence
+
+    return Features(
+        {
+            "dataset": Value("string"),
+            "image_id": Value("int64"),
+            "image": DImage(),
+            "alt_text": Value("string"),
+            "license": Value("string"),
+            "source": Value("string"),
+            "inclusive_alt_text": Value("string"),
+            "need_training": ClassLabel(names=["no", "yes"]),
+            "verified": ClassLabel(names=["no", "yes"]),
+            "rejection_reasons": Sequence(Value("string")),
+            "added_by": Value("string"),
+            "verified_by": Value("string"),
+            "modified_date": Value("timestamp[ns]"),
+            "nsfw": ClassLabel(names=["no", "yes"]),
+            "golden": ClassLabel(names=["no", "yes"]),
+            "gpt_alt_text": Value("string"),
+        }
+    )
+
+
+def __getattr__(name):
+    # `from checkvite.db import features` keeps working
+    if name == "features":
+        return get_features()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# typed columns of the `entries` table, rejection reasons live in their own
+# table and any other field is kept as JSON in the `extra` column.
+COLUMNS = (
+    "image_id",
+    "dataset",
+    "image",
+    "alt_text",
+    "license",
+    "source",
+    "inclusive_alt_text",
+    "need_training",
+    "verified",
+    "added_by",
+    "verified_by",
+    "modified_date",
+    "nsfw",
+    "golden",
+    "gpt_alt_text",
+)
+
+UPSERT_ENTRY = """
+    INSERT INTO entries (key, {columns}, extra) VALUES (?, {placeholders}, ?)
+    ON CONFLICT(key) DO UPDATE SET {updates}, extra = excluded.extra
+""".format(
+    columns=", ".join(COLUMNS),
+    placeholders=", ".join("?" for _ in COLUMNS),
+    updates=", ".join(f"{column} = excluded.{column}" for column in COLUMNS),
 )
 
 
+# seconds the change log of the shared mode is kept, a process that falls
+# further behind reloads everything
+CHANGES_RETENTION = 3600
+
+# sqlite PRAGMA synchronous value for each durability level, "full" also
+# commits every write instead of grouping them.
+DURABILITY = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+
+def _column_value(field):
+    if isinstance(field, datetime):
+        return field.isoformat()
+    return field
+
+
+def _entry_to_row(key, value):
+    row = [key]
+    for column in COLUMNS:
+        row.append(_column_value(value.get(column)))
+    extra = {
+        name: field
+        for name, field in value.items()
+        if name not in COLUMNS and name != "rejection_reasons"
+    }
+    row.append(json.dumps(extra, cls=CustomJSONEncoder) if extra else None)
+    reasons = [
+        (key, i, reason)
+        for i, reason in enumerate(value.get("rejection_reasons") or [])
+    ]
+    return row, reasons
+
+
+def _row_to_entry(row, reasons):
+    entry = dict(zip(COLUMNS, row[1:-1]))
+    entry["rejection_reasons"] = reasons
+    if row[-1]:
+        entry.update(json.loads(row[-1]))
+    return entry
+
+
+def _batches(items, size):
+    items = iter(items)
+    while batch := list(itertools.islice(items, size)):
+        yield batch
+
+
+def _open_dataset(dataset_name, split):
+    # a directory written by `save_to_disk` is opened as is, anything else
+    # (hub name, local data files) is streamed. Images are left encoded so
+    # the import workers decode them.
+    from datasets import load_dataset, load_from_disk, DatasetDict, Image as DImage
+
+    if os.path.isdir(dataset_name) and (
+        os.path.exists(os.path.join(dataset_name, "state.json"))
+        or os.path.exists(os.path.join(dataset_name, "dataset_dict.json"))
+    ):
+        dataset = load_from_disk(dataset_name)
+        if isinstance(dataset, DatasetDict):
+            dataset = dataset[split]
+    else:
+        dataset = load_dataset(dataset_name, split=split, streaming=True)
+    if dataset.features and "image" in dataset.features:
+        dataset = dataset.cast_column("image", DImage(decode=False))
+    return dataset
+
+
+def _other_file(path, new_path):
+    if not isinstance(path, str) or not isinstance(new_path, str):
+        return True
+    return os.path.abspath(path) != os.path.abspath(new_path)
+
+
+def _encode_image(job):
+    # runs in the import pool, stores the image with the storage codec and
+    # writes its thumbnails, returns the image path
+    from PIL import Image
+
+    image, key, store, thumbnails, codec = job
+    data = image["bytes"]
+    if data is None:
+        with open(image["path"], "rb") as f:
+            data = f.read()
+    with Image.open(BytesIO(data)) as img:
+        if img.format != codec.format:
+            data = codec.to_bytes(img)
+        image_path = store.put(data, codec.extension)
+        if thumbnails is not None:
+            thumbnails.render(key, image_path, img)
+    return image_path
+
+
+class LRUCache:
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def info(self):
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class TimedCursor(sqlite3.Cursor):
+    # the time spent executing and fetching goes to the histogram of the
+    # connection, by kind of the last statement
+    statement = "OTHER"
+
+    def execute(self, sql, *args):
+        self.statement = sql.lstrip().split(None, 1)[0].upper()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self._observe(start)
+
+    def executemany(self, sql, *args):
+        self.statement = sql.lstrip().split(None, 1)[0].upper()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self._observe(start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._observe(start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._observe(start)
+
+    def _observe(self, start):
+        self.connection.queries.observe(time.perf_counter() - start, self.statement)
+
+
+class TimedConnection(sqlite3.Connection):
+    # `queries` and `commits` are set by PersistentOrderedDict._connect
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            self.commits.observe(time.perf_counter() - start)
+
+    def __exit__(self, kind, value, traceback):
+        # the builtin one commits without going through commit()
+        if kind is not None:
+            self.rollback()
+            return False
+        try:
+            self.commit()
+        except BaseException:
+            self.rollback()
+            raise
+        return False
+
+
 class PersistentOrderedDict(OrderedDict):
     def __init__(
         self,
@@ -60,6 +298,15 @@ class PersistentOrderedDict(OrderedDict):
         key_name=None,
         split="train",
         read_only=False,
+        lazy=False,
+        cache_size=10000,
+        durability="normal",
+        flush_size=100,
+        flush_interval=1.0,
+        thumbnails=None,
+        codec=None,
+        shared=False,
+        snapshot=None,
         *args,
         **kwargs,
     ):
@@ -68,30 +315,143 @@ class PersistentOrderedDict(OrderedDict):
         self.last_local_update = 0
         self.last_push = 0
         self.image_dir = image_dir
-        os.makedirs(self.image_dir, exist_ok=True)
+        # ThumbnailStore rendering the thumbnails of the images written here
+        self.thumbnails = thumbnails
+        # Codec the images are stored with, PNG unless configured otherwise
+        self.codec = codec or get_codec("png")
+        self.store = ImageStore(self.image_dir)
+        # image files an entry stopped pointing to, removed after the next
+        # commit if no other entry references them
+        self.released = set()
         need_creation = not os.path.exists(self.db_file)
         self.read_only = read_only
-        self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        # in lazy mode only the keys are resident, entries are loaded on
+        # demand and kept in a bounded LRU cache.
+        self.lazy = lazy
+        self.cache = LRUCache(cache_size)
+        # `lock` guards the in-memory state, `write_lock` the writer
+        # connection. Reads go through one read-only connection per thread.
+        self.lock = threading.RLock()
+        self.write_lock = threading.RLock()
+        self.readers = threading.local()
+        self.queries = Histogram(
+            "checkvite_sqlite_query_seconds",
+            "Time spent executing SQLite statements and fetching their rows.",
+            ("statement",),
+        )
+        self.commits = Histogram(
+            "checkvite_sqlite_commit_seconds", "Time spent in SQLite commits."
+        )
+        self.conn = self._connect(self.db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA synchronous={DURABILITY[durability]}")
         self.cursor = self.conn.cursor()
-        if need_creation:
-            self._create_tables()
+        # write-behind journal, key -> (entry, changed fields or None for
+        # the whole entry), flushed in a single transaction.
+        self.pending = {}
+        self.flushing = {}
+        self.pending_since = None
+        # bumped whenever the store changes under the cache, a row read
+        # meanwhile is not cached
+        self.generation = 0
+        self.flush_size = 1 if durability == "full" else flush_size
+        self.flush_interval = flush_interval
+        # highest image id handed out or stored, persisted with the entries
+        self.last_id = 0
+        # in shared mode other processes write to the same file, each commit
+        # is logged in `changes` and `last_change` is the last one applied
+        self.shared = shared
+        self.writer_id = f"{os.getpid()}-{time.time_ns()}"
+        self.last_change = 0
+        self.epoch = None
+        self.data_version = None
+        self.last_trim = 0
+        self._create_tables()
+        if not need_creation:
+            if read_only:
+                self._check_json_table()
+            else:
+                self._migrate_json_table()
+                self._migrate_flat_images()
         super().__init__(*args, **kwargs)
-        if need_creation:
-            if dataset_name and key_name:
-                self.load_from_ds(dataset_name, key_name, split)
-        else:
+        if shared:
+            self.last_change = self.change_position()
+            self.epoch = self._load_epoch()
+        # kept when it matches the store, the Database restores its index
+        # from it and drops it
+        self.snapshot = None
+        if snapshot is not None and snapshot["tokens"] == self.snapshot_tokens():
+            self.snapshot = snapshot
+        if self.snapshot is not None and lazy:
+            for key in snapshot["keys"]:
+                super().__setitem__(key, None)
+        elif not need_creation:
             self._load_from_db()
+        if dataset_name and key_name:
+            if need_creation or self._import_pending(dataset_name, split):
+                self.load_from_ds(dataset_name, key_name, split)
         self._load_timestamps()
+        self._load_sequence()
 
     def _create_tables(self):
         self.cursor.execute(
             """
-            CREATE TABLE IF NOT EXISTS data (
+            CREATE TABLE IF NOT EXISTS entries (
                 key TEXT PRIMARY KEY,
-                value TEXT
+                image_id INTEGER,
+                dataset TEXT,
+                image TEXT,
+                alt_text TEXT,
+                license TEXT,
+                source TEXT,
+                inclusive_alt_text TEXT,
+                need_training INTEGER DEFAULT 0,
+                verified INTEGER DEFAULT 0,
+                added_by TEXT,
+                verified_by TEXT,
+                modified_date TEXT,
+                nsfw INTEGER DEFAULT 0,
+                golden INTEGER DEFAULT 0,
+                gpt_alt_text TEXT,
+                extra TEXT
+            )
+        """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rejection_reasons (
+                key TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                PRIMARY KEY (key, position)
             )
         """
         )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS entries_image_id ON entries (image_id)"
+        )
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS entries_flags
+            ON entries (verified, need_training, image_id)
+        """
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS entries_added_by ON entries (added_by, image_id)"
+        )
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS entries_verified_by ON entries (verified_by)"
+        )
+        # the references to an image file are counted on this index
+        self.cursor.execute(
+            "CREATE INDEX IF NOT EXISTS entries_image ON entries (image)"
+        )
+        self.cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS rejection_reasons_reason
+            ON rejection_reasons (reason)
+        """
+        )
         self.cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS timestamps (
@@ -100,6 +460,24 @@ class PersistentOrderedDict(OrderedDict):
             )
         """
         )
+        # one row per dataset import, `done` stays 0 until the last batch is
+        # written so an interrupted import is resumed on the next start.
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS imports (
+                source TEXT PRIMARY KEY,
+                done INTEGER
+            )
+        """
+        )
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sequences (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """
+        )
         self.cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS feedback (
@@ -108,51 +486,646 @@ class PersistentOrderedDict(OrderedDict):
             )
         """
         )
+        # `before` holds the counted fields of the entry as committed before
+        # the change, JSON null when the entry did not exist
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                writer TEXT NOT NULL,
+                before TEXT,
+                at REAL
+            )
+        """
+        )
         self.conn.commit()
 
-    def set_feedback(self, image_id, feedback):
+    def _has_json_table(self):
         self.cursor.execute(
-            "REPLACE INTO feedback (image_id, feedback) VALUES (?, ?)",
-            (image_id, feedback),
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'data'"
         )
+        return self.cursor.fetchone() is not None
+
+    def _check_json_table(self):
+        # a read-only open never migrates, the entries are not readable yet
+        if self._has_json_table():
+            raise ValueError(
+                f"{self.db_file} uses the old JSON schema, open it once without "
+                "read_only to migrate it"
+            )
+
+    def _migrate_json_table(self):
+        # databases created before the columnar schema kept one JSON blob
+        # per entry in `data`, we convert them once and drop the old table.
+        if not self._has_json_table():
+            return
+        print("Migrating the data table to the columnar schema...")
+        self.cursor.execute("SELECT key, value FROM data ORDER BY rowid")
+        for key, value in self.cursor.fetchall():
+            self._write_entry(key, json.loads(value))
+        self.cursor.execute("DROP TABLE data")
         self.conn.commit()
 
+    def _migrate_flat_images(self, batch_size=1000):
+        # image directories written before the content-addressed store kept
+        # one <key>.<ext> file per entry, they are linked into the store and
+        # the flat files removed once the entries point to the new paths.
+        if next(self.store.flat_files(), None) is None:
+            return
+        self.cursor.execute("SELECT DISTINCT image FROM entries")
+        paths = [
+            path
+            for (path,) in self.cursor.fetchall()
+            if isinstance(path, str)
+            and self.store.owns(path)
+            and not self.store.is_sharded(path)
+            and os.path.exists(path)
+        ]
+        if not paths:
+            return
+        print(f"Moving {len(paths)} images to the content-addressed store...")
+        from tqdm import tqdm
+
+        for i in tqdm(range(0, len(paths), batch_size), desc="Moving images"):
+            batch = paths[i : i + batch_size]
+            with ThreadPoolExecutor() as pool:
+                moved = list(zip(batch, pool.map(self.store.adopt, batch)))
+            with self.conn:
+                self.cursor.executemany(
+                    "UPDATE entries SET image = ? WHERE image = ?",
+                    [(new_path, path) for path, new_path in moved],
+                )
+            for path, _ in moved:
+                self.store.remove(path)
+
+    def _connect(self, database, **kwargs):
+        conn = sqlite3.connect(
+            database, check_same_thread=False, factory=TimedConnection, **kwargs
+        )
+        conn.queries = self.queries
+        conn.commits = self.commits
+        return conn
+
+    def _reader(self):
+        if not hasattr(self.readers, "cursor"):
+            conn = self._connect(f"file:{self.db_file}?mode=ro", uri=True)
+            self.readers.cursor = conn.cursor()
+        return self.readers.cursor
+
+    def set_feedback(self, image_id, feedback):
+        with self.write_lock:
+            self.cursor.execute(
+                "REPLACE INTO feedback (image_id, feedback) VALUES (?, ?)",
+                (image_id, feedback),
+            )
+            self.conn.commit()
+
     def get_feedback(self, image_ids):
         placeholders = ",".join("?" for _ in image_ids)
-        self.cursor.execute(
+        cursor = self._reader()
+        cursor.execute(
             f"SELECT image_id, feedback FROM feedback WHERE image_id IN ({placeholders})",
             image_ids,
         )
         res = dict(
-            [(int(image_id), feedback) for image_id, feedback in self.cursor.fetchall()]
+            [(int(image_id), feedback) for image_id, feedback in cursor.fetchall()]
         )
 
         return res
 
     def _load_from_db(self):
-        self.cursor.execute("SELECT key, value FROM data")
-        rows = self.cursor.fetchall()
-        for key, value in rows:
-            super().__setitem__(key, json.loads(value))
+        if self.lazy:
+            self.cursor.execute("SELECT key FROM entries ORDER BY rowid")
+            for (key,) in self.cursor.fetchall():
+                super().__setitem__(key, None)
+            return
+        reasons = {}
+        self.cursor.execute(
+            "SELECT key, reason FROM rejection_reasons ORDER BY key, position"
+        )
+        for key, reason in self.cursor.fetchall():
+            reasons.setdefault(key, []).append(reason)
+        self.cursor.execute(
+            f"SELECT key, {', '.join(COLUMNS)}, extra FROM entries ORDER BY rowid"
+        )
+        for row in self.cursor.fetchall():
+            super().__setitem__(row[0], _row_to_entry(row, reasons.get(row[0], [])))
+
+    def _select_entries(self, keys, cursor=None):
+        placeholders = ",".join("?" for _ in keys)
+        reasons = {}
+        cursor = cursor or self._reader()
+        cursor.execute(
+            f"""
+            SELECT key, reason FROM rejection_reasons
+            WHERE key IN ({placeholders}) ORDER BY key, position
+        """,
+            keys,
+        )
+        for key, reason in cursor.fetchall():
+            reasons.setdefault(key, []).append(reason)
+        cursor.execute(
+            f"""
+            SELECT key, {', '.join(COLUMNS)}, extra FROM entries
+            WHERE key IN ({placeholders})
+        """,
+            keys,
+        )
+        return {
+            row[0]: _row_to_entry(row, reasons.get(row[0], []))
+            for row in cursor.fetchall()
+        }
+
+    def _iter_items(self, chunk_size=500):
+        # scans every entry in order without going through the LRU cache
+        self.flush()
+        with self.lock:
+            keys = list(self.keys())
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i : i + chunk_size]
+            with self.lock:
+                cached = {key: self.cache.data.get(key) for key in chunk}
+            missing = [key for key in chunk if cached[key] is None]
+            loaded = self._select_entries(missing) if missing else {}
+            for key in chunk:
+                yield key, cached[key] or loaded[key]
+
+    def items(self):
+        if not self.lazy:
+            return super().items()
+        return self._iter_items()
+
+    def values(self):
+        if not self.lazy:
+            return super().values()
+        return (value for _, value in self._iter_items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def _write_entry(self, key, value):
+        row, reasons = _entry_to_row(key, value)
+        self.cursor.execute(UPSERT_ENTRY, row)
+        self._write_reasons(key, reasons)
+
+    def _write_reasons(self, key, reasons):
+        self.cursor.execute("DELETE FROM rejection_reasons WHERE key = ?", (key,))
+        self.cursor.executemany(
+            "INSERT INTO rejection_reasons (key, position, reason) VALUES (?, ?, ?)",
+            reasons,
+        )
+
+    def _write_fields(self, key, value, fields):
+        columns = [field for field in fields if field in COLUMNS]
+        if len(columns) + ("rejection_reasons" in fields) < len(fields):
+            # some of the fields are kept in the extra JSON column
+            return self._write_entry(key, value)
+        if columns:
+            self.cursor.execute(
+                f"UPDATE entries SET {', '.join(f'{c} = ?' for c in columns)} "
+                "WHERE key = ?",
+                [_column_value(value.get(column)) for column in columns] + [key],
+            )
+        if "rejection_reasons" in fields:
+            reasons = value.get("rejection_reasons") or []
+            self._write_reasons(key, [(key, i, r) for i, r in enumerate(reasons)])
+
+    def _load_sequence(self):
+        # databases created before the sequence existed start from the
+        # highest stored id, which is an index lookup.
+        self.cursor.execute("SELECT value FROM sequences WHERE name = 'image_id'")
+        row = self.cursor.fetchone()
+        self.cursor.execute("SELECT MAX(image_id) FROM entries")
+        (highest,) = self.cursor.fetchone()
+        self.last_id = max(self.last_id, row[0] if row else 0, highest or 0)
+
+    def _load_epoch(self):
+        # drawn once per database file, the processes sharing it count their
+        # versions from the same one
+        self.cursor.execute(
+            "INSERT OR IGNORE INTO sequences (name, value) VALUES ('epoch', ?)",
+            (time.time_ns(),),
+        )
+        self.conn.commit()
+        self.cursor.execute("SELECT value FROM sequences WHERE name = 'epoch'")
+        return f"{self.cursor.fetchone()[0]:x}"
+
+    def _write_sequence(self):
+        # never moves back, another process may have allocated higher ids
+        self.cursor.execute(
+            """
+            INSERT INTO sequences (name, value) VALUES ('image_id', ?)
+            ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+        """,
+            (self.last_id,),
+        )
+
+    def _see_id(self, value):
+        image_id = value.get("image_id")
+        if image_id is not None and int(image_id) > self.last_id:
+            self.last_id = int(image_id)
+
+    def next_id(self):
+        if not self.shared:
+            with self.lock:
+                self.last_id += 1
+                return self.last_id
+        # the processes allocate from the stored sequence, one transaction
+        # per id
+        with self.write_lock:
+            with self.conn:
+                self._write_sequence()
+                self.cursor.execute(
+                    "UPDATE sequences SET value = value + 1 WHERE name = 'image_id'"
+                )
+                self.cursor.execute(
+                    "SELECT value FROM sequences WHERE name = 'image_id'"
+                )
+                (image_id,) = self.cursor.fetchone()
+            with self.lock:
+                self.last_id = max(self.last_id, image_id)
+        return image_id
+
+    def _journal(self, key, value, fields=None):
+        self._see_id(value)
+        if key in self.pending:
+            previous = self.pending[key][1]
+            fields = None if previous is None or fields is None else previous | fields
+        self.pending[key] = (value, fields)
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+
+    def flush_if_due(self):
+        with self.lock:
+            due = self.pending and (
+                len(self.pending) >= self.flush_size
+                or time.monotonic() - self.pending_since >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        # the batch is written without holding `lock` so readers are not
+        # blocked by the commit, they find the entries in `flushing`.
+        with self.write_lock:
+            with self.lock:
+                if not self.pending:
+                    return
+                self.flushing, self.pending = self.pending, {}
+                self.pending_since = None
+            try:
+                with self.conn:
+                    if self.shared:
+                        # the logged states must be the ones this write replaces
+                        self.cursor.execute("BEGIN IMMEDIATE")
+                        self._log_changes(list(self.flushing))
+                    for key, (value, fields) in self.flushing.items():
+                        if fields is None:
+                            self._write_entry(key, value)
+                        else:
+                            self._write_fields(key, value, fields)
+                    self._write_timestamps()
+                    self._write_sequence()
+            except BaseException:
+                # rolled back, the batch is written with the next flush
+                with self.lock:
+                    self._restore_flushing()
+                raise
+            with self.lock:
+                self.flushing = {}
+                self.generation += 1
+            self._collect_released()
+
+    def _restore_flushing(self):
+        # puts a batch that failed to commit back in the journal, merged with
+        # the changes journaled since
+        restored = dict(self.flushing)
+        for key, (value, fields) in self.pending.items():
+            if key in restored:
+                previous = restored[key][1]
+                fields = (
+                    None if previous is None or fields is None else previous | fields
+                )
+            restored[key] = (value, fields)
+        self.pending = restored
+        self.flushing = {}
+        if restored and self.pending_since is None:
+            self.pending_since = time.monotonic()
+
+    def _counted_rows(self, keys, cursor):
+        # the counted fields of the stored entries, see _counted_fields()
+        placeholders = ",".join("?" for _ in keys)
+        cursor.execute(
+            f"""
+            SELECT key, reason FROM rejection_reasons
+            WHERE key IN ({placeholders}) ORDER BY key, position
+        """,
+            keys,
+        )
+        reasons = {}
+        for key, reason in cursor.fetchall():
+            reasons.setdefault(key, []).append(reason)
+        cursor.execute(
+            f"""
+            SELECT key, image_id, added_by, verified, need_training FROM entries
+            WHERE key IN ({placeholders})
+        """,
+            keys,
+        )
+        return {
+            key: {
+                "image_id": image_id,
+                "added_by": added_by,
+                "verified": verified,
+                "need_training": need_training,
+                "rejection_reasons": reasons.get(key, []),
+            }
+            for key, image_id, added_by, verified, need_training in cursor.fetchall()
+        }
+
+    def _log_changes(self, keys):
+        # runs in the write transaction
+        now = time.time()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            before = self._counted_rows(chunk, self.cursor)
+            self.cursor.executemany(
+                "INSERT INTO changes (key, writer, before, at) VALUES (?, ?, ?, ?)",
+                [
+                    (key, self.writer_id, json.dumps(before.get(key)), now)
+                    for key in chunk
+                ],
+            )
+        if now - self.last_trim > 60:
+            self.last_trim = now
+            self.cursor.execute(
+                "DELETE FROM changes WHERE at < ?", (now - CHANGES_RETENTION,)
+            )
+
+    def snapshot_tokens(self):
+        # changes with every committed write, a snapshot of the in-memory
+        # state is only valid for the tokens it was taken with
+        self.cursor.execute(
+            "SELECT timestamp FROM timestamps WHERE name = 'last_local_update'"
+        )
+        row = self.cursor.fetchone()
+        self.cursor.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM entries")
+        rows, last_row = self.cursor.fetchone()
+        return [row[0] if row else None, rows, last_row, self.change_position()]
+
+    def change_position(self):
+        self.cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM changes")
+        return self.cursor.fetchone()[0]
+
+    def poll_changes(self):
+        # what the other processes committed since the last call, as
+        # (key, counted fields before, entry or None) with one item per key,
+        # the keys also written here, whose logged state may not be the one
+        # we counted, and when there are such keys what the counters count
+        # in the same snapshot. None when the log does not cover it anymore,
+        # the caller then reloads everything.
+        with self.write_lock:
+            position = self.change_position()
+            self.cursor.execute("PRAGMA data_version")
+            (data_version,) = self.cursor.fetchone()
+            if data_version == self.data_version:
+                # nobody else committed before the position was read, what
+                # was logged since the last call is ours
+                self.last_change = position
+                return [], set(), None
+            self.data_version = data_version
+            # our own changes first so an entry both sides changed is read
+            # back as the store merged it
+            self.flush()
+            # the log and the entries are read from the same snapshot
+            self.cursor.execute("BEGIN")
+            try:
+                self.cursor.execute(
+                    "SELECT seq, key, writer, before FROM changes "
+                    "WHERE seq > ? ORDER BY seq",
+                    (self.last_change,),
+                )
+                rows = self.cursor.fetchall()
+                if not rows:
+                    return [], set(), None
+                # seq has no holes, the rows we missed have been trimmed
+                missed = rows[0][0] != self.last_change + 1
+                self.last_change = rows[-1][0]
+                if missed:
+                    return None
+                before, own = {}, set()
+                for _, key, writer, state in rows:
+                    if writer == self.writer_id:
+                        own.add(key)
+                    elif key not in before:
+                        before[key] = json.loads(state)
+                keys = list(before)
+                entries = {}
+                for i in range(0, len(keys), 500):
+                    entries.update(self._select_entries(keys[i : i + 500], self.cursor))
+                conflicts = own.intersection(keys)
+                counts = None
+                if conflicts:
+                    self.cursor.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(verified = 1), 0), "
+                        "COALESCE(SUM(need_training = 1), 0) FROM entries"
+                    )
+                    counts = list(self.cursor.fetchone())
+                    self.cursor.execute(
+                        "SELECT reason, COUNT(*) FROM rejection_reasons GROUP BY reason"
+                    )
+                    counts.append(dict(self.cursor.fetchall()))
+            finally:
+                self.conn.commit()
+        with self.lock:
+            if any(key in self.pending or key in self.flushing for key in keys):
+                # journaled while we were reading, rare enough
+                return None
+        return (
+            [(key, before[key], entries.get(key)) for key in keys],
+            conflicts,
+            counts,
+        )
+
+    def apply_change(self, key, value):
+        # takes an entry written by another process, with `lock` held
+        self.generation += 1
+        if value is None:
+            if key in self:
+                super().__delitem__(key)
+            self.cache.pop(key)
+            return
+        self._see_id(value)
+        if self.lazy:
+            super().__setitem__(key, None)
+            self.cache.pop(key)
+        else:
+            super().__setitem__(key, value)
+
+    def reload(self):
+        # drops the in-memory state and loads it again from the store
+        self.flush()
+        with self.write_lock, self.lock:
+            self.last_change = self.change_position()
+            self.data_version = None
+            self.generation += 1
+            super().clear()
+            self.cache.clear()
+            self._load_from_db()
+            self._load_sequence()
+
+    def _collect_released(self):
+        # removes the released image files no entry references anymore, an
+        # unflushed entry may still point to one of them
+        with self.lock:
+            if not self.released:
+                return
+            released, self.released = self.released, set()
+            unflushed = {
+                value.get("image")
+                for journal in (self.pending, self.flushing)
+                for value, _ in journal.values()
+            }
+        with self.write_lock:
+            for path in released:
+                if not isinstance(path, str):
+                    continue
+                if path in unflushed:
+                    with self.lock:
+                        self.released.add(path)
+                    continue
+                self.cursor.execute(
+                    "SELECT 1 FROM entries WHERE image = ? LIMIT 1", (path,)
+                )
+                if self.cursor.fetchone() is None and self.store.owns(path):
+                    self.store.remove(path)
+
+    def count_flags(self):
+        self.flush()
+        cursor = self._reader()
+        cursor.execute(
+            """
+            SELECT COUNT(*),
+                   COALESCE(SUM(verified = 1), 0),
+                   COALESCE(SUM(need_training = 1), 0)
+            FROM entries
+        """
+        )
+        return cursor.fetchone()
+
+    def index_rows(self):
+        self.flush()
+        cursor = self._reader()
+        cursor.execute(
+            """
+            SELECT image_id, added_by, verified, need_training
+            FROM entries ORDER BY image_id
+        """
+        )
+        return cursor.fetchall()
+
+    def rejection_counts(self):
+        self.flush()
+        cursor = self._reader()
+        cursor.execute("SELECT reason, COUNT(*) FROM rejection_reasons GROUP BY reason")
+        return dict(cursor.fetchall())
 
     def _convert_image_to_path(self, key, item):
+        from PIL import Image
+
         if "image" in item and isinstance(item["image"], Image.Image):
-            image_path = os.path.join(self.image_dir, f"{key}.png")
-            item["image"].save(image_path, format="PNG")
+            image_path = self.store.put_image(item["image"], self.codec)
+            if self.thumbnails is not None:
+                self.thumbnails.render(str(key), image_path, item["image"])
             item["image"] = image_path
         return item
 
+    def _unflushed(self, key):
+        for journal in (self.pending, self.flushing):
+            if key in journal:
+                return journal[key][0]
+        return None
+
     def __getitem__(self, key):
-        return super().__getitem__(str(key))
-
-    def _convert_image_from_path(self, item):
-        if (
-            "image" in item
-            and isinstance(item["image"], str)
-            and os.path.exists(item["image"])
-        ):
-            item["image"] = Image.open(item["image"])
-        return item
+        key = str(key)
+        with self.lock:
+            value = super().__getitem__(key)
+            if not self.lazy:
+                return value
+            value = self._unflushed(key) or self.cache.get(key)
+        if value is not None:
+            return value
+        while True:
+            with self.lock:
+                generation = self.generation
+            value = self._select_entries([key])[key]
+            with self.lock:
+                # the entry may have been loaded or written while we were
+                # reading, a row read while the store changed may predate
+                # the change and is read again
+                current = self._unflushed(key) or self.cache.data.get(key)
+                if current is not None:
+                    return current
+                if self.generation == generation:
+                    self.cache.put(key, value)
+                    return value
+
+    def get_many(self, keys):
+        # key -> entry for the stored keys, the entries not in memory are
+        # read in one query and cached
+        keys = [str(key) for key in keys]
+        if not self.lazy:
+            with self.lock:
+                return {key: self[key] for key in keys if key in self}
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self:
+                    value = self._unflushed(key) or self.cache.get(key)
+                    if value is not None:
+                        found[key] = value
+            missing = [key for key in keys if key not in found and key in self]
+            generation = self.generation
+        while missing:
+            loaded = self._select_entries(missing)
+            with self.lock:
+                missing = []
+                for key, value in loaded.items():
+                    # the entry may have been loaded or written meanwhile
+                    current = self._unflushed(key) or self.cache.data.get(key)
+                    if current is not None:
+                        found[key] = current
+                    elif self.generation == generation:
+                        self.cache.put(key, value)
+                        found[key] = value
+                    else:
+                        # read while the store changed, see __getitem__()
+                        missing.append(key)
+                generation = self.generation
+        return found
+
+    def cached(self, keys):
+        with self.lock:
+            if not self.lazy:
+                return len(keys)
+            return sum(
+                str(key) in self.cache.data or self._unflushed(str(key)) is not None
+                for key in keys
+            )
+
+    def _export_image(self, image):
+        # the encoded file is passed through, `features` stores it as is
+        if isinstance(image, str) and os.path.exists(image):
+            with open(image, "rb") as f:
+                return {"bytes": f.read(), "path": os.path.basename(image)}
+        return image
 
     def __setitem__(self, key, value):
         if self.read_only:
@@ -160,35 +1133,124 @@ class PersistentOrderedDict(OrderedDict):
         key = str(key)
         value = self._convert_image_to_path(key, value)
         value["modified_date"] = datetime.now().isoformat()
-        super().__setitem__(key, value)
-        self.cursor.execute(
-            "REPLACE INTO data (key, value) VALUES (?, ?)",
-            (key, json.dumps(value, cls=CustomJSONEncoder)),
-        )
-        self.conn.commit()
-        self._update_local_timestamp()
+        with self.lock:
+            if self.lazy:
+                super().__setitem__(key, None)
+                self.cache.put(key, value)
+            else:
+                super().__setitem__(key, value)
+            self._update_local_timestamp()
+            self._journal(key, value)
+        self.flush_if_due()
+
+    def update_entry(self, key, **fields):
+        # only journals the change, it is written by flush_if_due() or flush()
+        if self.read_only:
+            raise ValueError("Cannot set item in read-only mode")
+        key = str(key)
+        with self.lock:
+            value = self[key]
+            if "image" in fields and _other_file(value.get("image"), fields["image"]):
+                self.released.add(value.get("image"))
+            value.update(fields)
+            value["modified_date"] = datetime.now().isoformat()
+            self._update_local_timestamp()
+            self._journal(key, value, set(fields) | {"modified_date"})
+        return value
+
+    def write_entries(self, updates):
+        # commits {key: fields} in one transaction without journaling them,
+        # with `write_lock` held. Returns the entries before and as written,
+        # memory is left to the caller, see take_written().
+        if self.read_only:
+            raise ValueError("Cannot set item in read-only mode")
+        # the journal first, the batch is the newest state of its entries
+        self.flush()
+        previous = self.get_many(updates)
+        modified_date = datetime.now().isoformat()
+        with self.lock:
+            previous = {key: dict(previous[key]) for key in updates}
+            written = {
+                key: {**previous[key], **fields, "modified_date": modified_date}
+                for key, fields in updates.items()
+            }
+            self._update_local_timestamp()
+        with self.conn:
+            if self.shared:
+                self.cursor.execute("BEGIN IMMEDIATE")
+                self._log_changes(list(written))
+            for key, value in written.items():
+                self._write_fields(key, value, set(updates[key]) | {"modified_date"})
+            self._write_timestamps()
+        with self.lock:
+            self.generation += 1
+            for key, fields in updates.items():
+                image = previous[key].get("image")
+                if "image" in fields and _other_file(image, fields["image"]):
+                    self.released.add(image)
+        self._collect_released()
+        return previous, written
+
+    def take_written(self, key, previous, value, fields):
+        # puts an entry write_entries() committed in memory, returns the
+        # counted fields it had and the entry held now. The one held in
+        # memory may have changed since `previous` was read.
+        with self.lock:
+            if self.lazy:
+                held = self._unflushed(key) or self.cache.data.get(key)
+            else:
+                held = super().__getitem__(key)
+            if held is None:
+                self.cache.put(key, value)
+                return _counted_fields(previous), value
+            before = _counted_fields(held)
+            held.update({field: value[field] for field in fields})
+            held["modified_date"] = value["modified_date"]
+            return before, held
 
     def __delitem__(self, key):
         if self.read_only:
             raise ValueError("Cannot delete item in read-only mode")
-        super().__delitem__(key)
-        if os.path.exists(os.path.join(self.image_dir, f"{key}.png")):
-            os.remove(os.path.join(self.image_dir, f"{key}.png"))
-        self.cursor.execute("DELETE FROM data WHERE key = ?", (key,))
-        self.conn.commit()
-        self._update_local_timestamp()
+        key = str(key)
+        self.flush()
+        image_path = self[key].get("image")
+        with self.write_lock:
+            with self.lock:
+                self._update_local_timestamp()
+            # committed before the entry leaves memory, in the same kind of
+            # transaction as flush() in shared mode
+            with self.conn:
+                if self.shared:
+                    self.cursor.execute("BEGIN IMMEDIATE")
+                    self._log_changes([key])
+                self.cursor.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.cursor.execute(
+                    "DELETE FROM rejection_reasons WHERE key = ?", (key,)
+                )
+                self._write_timestamps()
+            with self.lock:
+                super().__delitem__(key)
+                self.cache.pop(key)
+                self.generation += 1
+                self.released.add(image_path)
+        self._collect_released()
 
     def clear(self):
         if self.read_only:
             raise ValueError("Cannot clear items in read-only mode")
-        super().clear()
-        for filename in os.listdir(self.image_dir):
-            file_path = os.path.join(self.image_dir, filename)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-        self.cursor.execute("DELETE FROM data")
-        self.conn.commit()
-        self._update_local_timestamp()
+        with self.write_lock, self.lock:
+            super().clear()
+            self.cache.clear()
+            self.generation += 1
+            self.pending.clear()
+            self.flushing = {}
+            self.pending_since = None
+            self._update_local_timestamp()
+            self.cursor.execute("DELETE FROM entries")
+            self.cursor.execute("DELETE FROM rejection_reasons")
+            self._save_timestamps()
+            self.released.clear()
+        self.store.clear()
 
     def update(self, *args, **kwargs):
         if self.read_only:
@@ -196,36 +1258,123 @@ class PersistentOrderedDict(OrderedDict):
         for key, value in dict(*args, **kwargs).items():
             self.__setitem__(key, value)
 
-    def load_from_ds(self, dataset_name, key_name, split="train"):
-        dataset = load_dataset(dataset_name, split=split)
-        for item in tqdm(dataset, desc="Loading dataset"):
-            key = item[key_name]
-            item = self._convert_image_to_path(key, item)
-            super().__setitem__(str(key), item)
-        self.cursor.executemany(
-            "REPLACE INTO data (key, value) VALUES (?, ?)",
-            [
-                (str(key), json.dumps(self[key], cls=CustomJSONEncoder))
-                for key in self.keys()
-            ],
+    def _import_pending(self, dataset_name, split):
+        self.cursor.execute(
+            "SELECT done FROM imports WHERE source = ?", (f"{dataset_name}:{split}",)
         )
-        self.conn.commit()
-        self._update_local_timestamp()
+        row = self.cursor.fetchone()
+        return row is not None and not row[0]
+
+    def _set_import(self, dataset_name, split, done):
+        with self.write_lock:
+            self.cursor.execute(
+                "REPLACE INTO imports (source, done) VALUES (?, ?)",
+                (f"{dataset_name}:{split}", int(done)),
+            )
+            self.conn.commit()
+
+    def load_from_ds(
+        self, dataset_name, key_name, split="train", batch_size=1000, workers=None
+    ):
+        # streams the dataset in batches, the images of the next batch are
+        # encoded in the process pool while the current one is written.
+        # Each batch is committed and the keys already stored are skipped,
+        # so an interrupted import picks up where it stopped.
+        from datasets import Dataset
+        from tqdm import tqdm
+
+        if self.read_only:
+            raise ValueError("Cannot load items in read-only mode")
+        dataset = _open_dataset(dataset_name, split)
+        self._set_import(dataset_name, split, False)
+        total = len(dataset) if isinstance(dataset, Dataset) else None
+        progress = tqdm(total=total, desc="Importing dataset", unit="entries")
+        with ProcessPoolExecutor(workers) as pool:
+            in_flight = None
+            for batch in _batches(dataset, batch_size):
+                progress.update(len(batch))
+                batch = [item for item in batch if str(item[key_name]) not in self]
+                jobs = []
+                targets = []
+                for item in batch:
+                    if isinstance(item.get("image"), dict):
+                        key = str(item[key_name])
+                        jobs.append(
+                            (
+                                item["image"],
+                                key,
+                                self.store,
+                                self.thumbnails,
+                                self.codec,
+                            )
+                        )
+                        targets.append(item)
+                    else:
+                        self._convert_image_to_path(item[key_name], item)
+                encoded = pool.map(_encode_image, jobs, chunksize=16)
+                if in_flight is not None:
+                    self._insert_batch(*in_flight, key_name)
+                in_flight = (batch, zip(targets, encoded))
+            if in_flight is not None:
+                self._insert_batch(*in_flight, key_name)
+        progress.close()
+        self._set_import(dataset_name, split, True)
+
+    def load_items(self, items, key_name="image_id", batch_size=1000):
+        if self.read_only:
+            raise ValueError("Cannot load items in read-only mode")
+        for batch in _batches(items, batch_size):
+            batch = [
+                self._convert_image_to_path(item[key_name], item) for item in batch
+            ]
+            self._insert_batch(batch, [], key_name)
 
-    def to_dataset(self):
-        full_data = {}
-        for key, value in self.items():
-            full_data[key] = self._convert_image_from_path(value.copy())
-        return Dataset.from_list(list(full_data.values()), features)
+    def _insert_batch(self, items, encoded, key_name):
+        # waits for the images of the batch, then writes it in one transaction
+        for item, image_path in encoded:
+            item["image"] = image_path
+        with self.write_lock:
+            for item in items:
+                key = str(item[key_name])
+                with self.lock:
+                    super().__setitem__(key, None if self.lazy else item)
+                    self._see_id(item)
+                self._write_entry(key, item)
+            self._update_local_timestamp()
+            self._write_sequence()
+            self._save_timestamps()
+
+    def _export_entries(self, chunk_size):
+        for _, value in self._iter_items(chunk_size):
+            entry = {name: value.get(name) for name in get_features()}
+            entry["image"] = self._export_image(entry["image"])
+            yield entry
+
+    def to_dataset(self, chunk_size=500):
+        # the Arrow file is written `chunk_size` entries at a time, the
+        # fingerprint changes with every local update so a stale export
+        # is never picked from the datasets cache.
+        from datasets import Dataset
+
+        return Dataset.from_generator(
+            self._export_entries,
+            features=get_features(),
+            gen_kwargs={"chunk_size": chunk_size},
+            writer_batch_size=chunk_size,
+            fingerprint=hashlib.sha1(
+                f"{os.path.abspath(self.db_file)}:{self.last_local_update}".encode()
+            ).hexdigest(),
+        )
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sync()
         self.conn.close()
 
     def sync(self):
-        self.conn.commit()
+        self.flush()
         self._save_timestamps()
 
     def _load_timestamps(self):
@@ -238,6 +1387,11 @@ class PersistentOrderedDict(OrderedDict):
                 self.last_push = timestamp
 
     def _save_timestamps(self):
+        with self.write_lock:
+            self._write_timestamps()
+            self.conn.commit()
+
+    def _write_timestamps(self):
         self.cursor.execute(
             "REPLACE INTO timestamps (name, timestamp) VALUES (?, ?)",
             ("last_local_update", self.last_local_update),
@@ -246,14 +1400,16 @@ class PersistentOrderedDict(OrderedDict):
             "REPLACE INTO timestamps (name, timestamp) VALUES (?, ?)",
             ("last_push", self.last_push),
         )
-        self.conn.commit()
 
     def _update_local_timestamp(self):
+        # saved with the next flush
         self.last_local_update = time.time()
-        self._save_timestamps()
 
     def push_to_hub(self, hub_dataset_id, force=False):
+        self.flush()
         if force or self.last_local_update > self.last_push:
+            from datasets import DatasetDict
+
             ds_dict = DatasetDict({"train": self.to_dataset()})
             ds_dict.push_to_hub(hub_dataset_id)
             self.last_push = time.time()
@@ -263,17 +1419,346 @@ class PersistentOrderedDict(OrderedDict):
         self.conn.commit()
 
 
-class Database:
+# the annotation tabs, as (verified, need_training) filters
+TABS = {
+    "to_verify": (0, 0),
+    "verified": (1, 0),
+    "to_train": (0, 1),
+    "check": (None, None),
+}
+
+
+def _sorted_contains(ids, image_id):
+    position = bisect.bisect_left(ids, image_id)
+    return position < len(ids) and ids[position] == image_id
+
+
+class SortedIndex:
     def __init__(self):
+        # ascending image ids, and the ids uploaded by each user
+        self.ids = []
+        self.own_uploads = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, image_id):
+        return _sorted_contains(self.ids, image_id)
+
+    def add(self, image_id, added_by):
+        for ids in (self.ids, self.own_uploads.setdefault(added_by, [])):
+            # held once even when the change was tracked against a stale state
+            position = bisect.bisect_left(ids, image_id)
+            if position == len(ids) or ids[position] != image_id:
+                ids.insert(position, image_id)
+
+    def remove(self, image_id, added_by):
+        for ids in (self.ids, self.own_uploads.get(added_by, [])):
+            position = bisect.bisect_left(ids, image_id)
+            if position < len(ids) and ids[position] == image_id:
+                del ids[position]
+
+    def runs(self, id_range=None, added_by=None):
+        # The scope is made of ascending runs of ids: the user uploads above
+        # the split, the split itself and the user uploads below it.
+        if id_range is None:
+            return [(self.ids, 0, len(self.ids))]
+        low, high = id_range
+        own = []
+        if added_by is not None:
+            own = self.own_uploads.get(added_by, [])
+        if low > high:
+            return [(own, 0, len(own))]
+        return [
+            (own, bisect.bisect_right(own, high), len(own)),
+            (
+                self.ids,
+                bisect.bisect_left(self.ids, low),
+                bisect.bisect_right(self.ids, high),
+            ),
+            (own, 0, bisect.bisect_left(own, low)),
+        ]
+
+    def page(self, start=0, amount=9, after=None, **scope):
+        # walks the runs backwards to get a page of descending ids, starting
+        # right below the `after` id when it's given.
+        page = []
+        for run, first, last in self.runs(**scope):
+            if after is not None:
+                last = bisect.bisect_left(run, after, first, last)
+            if start >= last - first:
+                start -= last - first
+                continue
+            last -= start
+            start = 0
+            taken = max(first, last - (amount - len(page)))
+            page.extend(reversed(run[taken:last]))
+            if len(page) >= amount:
+                break
+        return page
+
+
+class Counters:
+    def __init__(self, size=0, verified=0, need_training=0, rejection_reasons=None):
+        self.size = size
+        self.verified = verified
+        self.need_training = need_training
+        self.rejection_reasons = Counter(rejection_reasons or {})
+
+    @property
+    def to_verify(self):
+        return self.size - (self.verified + self.need_training)
+
+    def add(self, entry, sign=1):
+        self.size += sign
+        if entry.get("verified") == 1:
+            self.verified += sign
+        if entry.get("need_training") == 1:
+            self.need_training += sign
+        for reason in entry.get("rejection_reasons") or []:
+            self.rejection_reasons[reason] += sign
+            if self.rejection_reasons[reason] <= 0:
+                del self.rejection_reasons[reason]
+
+
+def _counted_fields(entry):
+    # copy of what the counters look at, entries are mutated in place
+    return {
+        "image_id": entry.get("image_id"),
+        "added_by": entry.get("added_by"),
+        "verified": entry.get("verified"),
+        "need_training": entry.get("need_training"),
+        "rejection_reasons": list(entry.get("rejection_reasons") or []),
+    }
+
+
+class Database:
+    def __init__(
+        self,
+        filename="alt-text",
+        dataset_name="Mozilla/alt-text-validation",
+        split="train",
+        key_name="image_id",
+        image_dir="images",
+        lazy=False,
+        cache_size=10000,
+        durability="normal",
+        thumbnail_sizes=(100,),
+        image_codec="png",
+        shared=False,
+    ):
         print("Loading dataset...")
+        self.snapshot_path = f"{filename}.index"
+        self.codec = get_codec(image_codec)
+        self.thumbnails = ThumbnailStore(image_dir, thumbnail_sizes, codec=self.codec)
         self.data_dict = PersistentOrderedDict(
-            "alt-text",
-            dataset_name="Mozilla/alt-text-validation",
-            split="train",
-            key_name="image_id",
+            filename,
+            image_dir=image_dir,
+            dataset_name=dataset_name,
+            split=split,
+            key_name=key_name,
+            lazy=lazy,
+            cache_size=cache_size,
+            durability=durability,
+            thumbnails=self.thumbnails,
+            codec=self.codec,
+            shared=shared,
+            snapshot=read_snapshot(self.snapshot_path),
         )
-        self.image_ids = list(self.data_dict.keys())
+        self.shared = shared
+        self.lock = self.data_dict.lock
         self.dirty = False
+        # bumped on every change, `epoch` tells the runs of the server apart
+        # so a version seen by a client before a restart never matches. In
+        # shared mode it comes from the store, see stamp.
+        self.epoch = self.data_dict.epoch or f"{time.time_ns():x}"
+        self.version = 0
+        # (last change applied, version) when memory last matched the store
+        # as of that change, in shared mode
+        self.synced = (0, 0)
+        # called with (before, after) counted fields on every change
+        self.listeners = []
+        if not self._restore(self.data_dict.snapshot):
+            self.rebuild_index()
+            self.rebuild_counters()
+        self.data_dict.snapshot = None
+        if shared and self.data_dict.change_position() != self.data_dict.last_change:
+            # another process wrote while we were loading
+            self.resync()
+        if shared:
+            self._mark_synced()
+
+    def _snapshot_indexes(self):
+        return [("all", self.index)] + [
+            (f"{verified},{need_training}", index)
+            for (verified, need_training), index in self.tabs.items()
+        ]
+
+    def _restore(self, snapshot):
+        if snapshot is None:
+            return False
+        self._empty_indexes()
+        try:
+            indexes = [
+                (index, snapshot["indexes"][name])
+                for name, index in self._snapshot_indexes()
+            ]
+        except KeyError:
+            return False
+        for index, (ids, own_uploads) in indexes:
+            index.ids = ids
+            index.own_uploads = own_uploads
+        self.counters = Counters(**snapshot["counters"])
+        return True
+
+    def save_snapshot(self):
+        # lets the next start skip the index rebuild, the snapshot is only
+        # written when the memory matches what is committed
+        self.data_dict.flush()
+        with self.data_dict.write_lock, self.lock:
+            if self.data_dict.pending or self.data_dict.flushing:
+                return False
+            tokens = self.data_dict.snapshot_tokens()
+            if self.shared and tokens[-1] != self.data_dict.last_change:
+                return False
+            counters = self.counters
+            return write_snapshot(
+                self.snapshot_path,
+                tokens,
+                list(self.data_dict.keys()),
+                self._snapshot_indexes(),
+                {
+                    "size": counters.size,
+                    "verified": counters.verified,
+                    "need_training": counters.need_training,
+                    "rejection_reasons": dict(counters.rejection_reasons),
+                },
+            )
+
+    def resync(self):
+        with self.data_dict.write_lock, self.lock:
+            while True:
+                self.data_dict.reload()
+                self.rebuild_index()
+                self.rebuild_counters()
+                if self.data_dict.change_position() == self.data_dict.last_change:
+                    break
+            self._mark_synced()
+
+    def sync_changes(self):
+        # applies what the other processes committed, in shared mode
+        polled = self.data_dict.poll_changes()
+        if polled is None:
+            print("Out of sync with the other processes, reloading")
+            self.resync()
+            return
+        changes, conflicts, counts = polled
+        with self.lock:
+            for key, before, entry in changes:
+                if key in conflicts:
+                    # also written here, maybe over a state we had not seen,
+                    # so it is indexed again and the counters recounted
+                    before = self._unindex(int(key))
+                self.data_dict.apply_change(key, entry)
+                after = _counted_fields(entry) if entry is not None else None
+                if before is None and after is None:
+                    continue
+                if key in conflicts:
+                    self._track(None, after, before)
+                else:
+                    self._track(before, after)
+                if before is None:
+                    self.data_dict.move_to_end(key, last=False)
+            if conflicts:
+                self.counters = Counters(*counts)
+            self._mark_synced()
+
+    def _mark_synced(self):
+        # with `lock` held, memory matches the store once nothing is journaled
+        if not self.data_dict.pending and not self.data_dict.flushing:
+            self.synced = (self.data_dict.last_change, self.version)
+
+    @property
+    def stamp(self):
+        # identifies the state the counters show. In shared mode two
+        # processes holding the same changes have the same one, whatever
+        # they did to get there.
+        if not self.shared:
+            return (self.epoch, self.version)
+        change, version = self.synced
+        return (self.epoch, change, self.version - version)
+
+    def _unindex(self, image_id):
+        # drops an id from all the indexes, returns its counted fields as
+        # they were indexed without the rejection reasons, None when it was
+        # not indexed
+        if image_id not in self.index:
+            return None
+        counted = {"image_id": image_id, "rejection_reasons": []}
+        counted["verified"], counted["need_training"] = next(
+            (tab for tab, index in self.tabs.items() if image_id in index),
+            (None, None),
+        )
+        for index in [self.index] + list(self.tabs.values()):
+            for added_by, ids in index.own_uploads.items():
+                if _sorted_contains(ids, image_id):
+                    counted["added_by"] = added_by
+                    index.remove(image_id, added_by)
+        return counted
+
+    def _empty_indexes(self):
+        self.index = SortedIndex()
+        # entries flagged both ways are in no tab but they are counted
+        self.tabs = {
+            tab: SortedIndex()
+            for tab in list(TABS.values()) + [(1, 1)]
+            if tab[0] is not None
+        }
+
+    def rebuild_index(self):
+        self._empty_indexes()
+        for image_id, added_by, verified, need_training in self.data_dict.index_rows():
+            for index in self._indexes(
+                {"verified": verified, "need_training": need_training}
+            ):
+                index.ids.append(image_id)
+                index.own_uploads.setdefault(added_by, []).append(image_id)
+
+    def _indexes(self, counted):
+        tab = (counted["verified"], counted["need_training"])
+        if tab in self.tabs:
+            return [self.index, self.tabs[tab]]
+        return [self.index]
+
+    def rebuild_counters(self):
+        self.counters = Counters(
+            *self.data_dict.count_flags(), self.data_dict.rejection_counts()
+        )
+        self.version += 1
+
+    def _track(self, before, after, seen=None):
+        # `seen` is what the listeners are told the entry was, when it
+        # differs from what is taken out of the indexes and counters
+        self.version += 1
+        self._reindex(before, after)
+        for counted, sign in ((before, -1), (after, 1)):
+            if counted is not None:
+                self.counters.add(counted, sign)
+        for listener in self.listeners:
+            listener(before if seen is None else seen, after)
+
+    def _reindex(self, before, after):
+        old = self._indexes(before) if before is not None else []
+        new = self._indexes(after) if after is not None else []
+        moved = (
+            before is None or after is None or before["added_by"] != after["added_by"]
+        )
+        for index in old:
+            if moved or index not in new:
+                index.remove(before["image_id"], before["added_by"])
+        for index in new:
+            if moved or index not in old:
+                index.add(after["image_id"], after["added_by"])
 
     def save(self):
         print("Saving")
@@ -288,78 +1773,69 @@ class Database:
 
     @property
     def verified(self):
-        return sum(1 for item in self.data_dict.values() if item.get("verified") == 1)
+        return self.counters.verified
 
     @property
     def need_training(self):
-        return sum(
-            1 for item in self.data_dict.values() if item.get("need_training") == 1
-        )
+        return self.counters.need_training
 
     @property
     def to_verify(self):
-        return len(self.data_dict) - (self.verified + self.need_training)
+        return self.counters.to_verify
 
     def get_rejection_stats(self):
-        rejection_stats = {}
-        for entry in self.data_dict.values():
-            for reason in entry.get("rejection_reasons", []):
-                if reason in rejection_stats:
-                    rejection_stats[reason] += 1
-                else:
-                    rejection_stats[reason] = 1
-        return rejection_stats
+        with self.lock:
+            return dict(self.counters.rejection_reasons)
 
     def get_user_stats(self, split, username):
-        items = self._get_sorted(split, username)
-
-        verified = sum(1 for item in items if item.get("verified") == 1)
-        need_training = sum(1 for item in items if item.get("need_training") == 1)
+        # counted on the tab indexes, O(log n) whatever the split
+        with self.lock:
+            scope = self._scope(split, username)
+            size, verified, need_training, both = (
+                sum(last - first for _, first, last in index.runs(**scope))
+                for index in (
+                    self.index,
+                    self.tabs[(1, 0)],
+                    self.tabs[(0, 1)],
+                    self.tabs[(1, 1)],
+                )
+            )
+        verified += both
+        need_training += both
         return {
             "u_need_training": need_training,
             "u_verified": verified,
-            "u_to_verify": len(items) - (verified + need_training),
+            "u_to_verify": size - (verified + need_training),
         }
 
-    def _get_sorted(self, split=None, username=None):
-        def sort_key(entry):
-            modified_date = entry.get("modified_date")
-
-            if modified_date is not None:
-                date = pd.Timestamp(modified_date).timestamp()
-            else:
-                date = pd.Timestamp(0).timestamp()
-
-            # XXX we can sort by date because it break the users split order
-            return -entry["image_id"]
-
-        all_entries = list(sorted(self.data_dict.values(), key=sort_key))
-
-        if split is not None:
-            user_entries = all_entries[split[0] : split[1]]
+    def _scope(self, split=None, username=None):
+        # A user split is a slice of the entries sorted by descending image_id,
+        # plus the images that were added by the user.
+        # XXX we can't sort by date because it breaks the users split order
+        if split is None:
+            return {}
+        ids = self.index.ids
+        start, end = split[0], min(split[1], len(ids))
+        if start < end:
+            id_range = (ids[len(ids) - end], ids[len(ids) - 1 - start])
         else:
-            user_entries = all_entries
-
-        current_ids = [v["image_id"] for v in user_entries]
-
-        # added images that were added by the user
+            id_range = (1, 0)
         if username is not None and username != "admin":
-            for entry in all_entries:
-                if (
-                    entry["image_id"] not in current_ids
-                    and entry["added_by"] == username
-                ):
-                    user_entries.append(entry)
-                    current_ids.append(entry["image_id"])
-
-        # sort again
-        return list(sorted(user_entries, key=sort_key))
+            return {"id_range": id_range, "added_by": username}
+        return {"id_range": id_range}
 
     def __getitem__(self, key):
         return self.data_dict[key]
 
     def __setitem__(self, key, value):
+        with self.lock:
+            if str(key) in self.data_dict:
+                before = _counted_fields(self.data_dict[key])
+            else:
+                before = None
         self.data_dict[key] = value
+        with self.lock:
+            self._track(before, _counted_fields(value))
         self.dirty = True
 
     def get_full_image(self, image_id):
@@ -375,12 +1851,26 @@ class Database:
         transform=None,
         split=None,
         username=None,
+        after=None,
     ):
-        return list(
-            self.get_images(
-                verified, need_training, index, 1, transform, split, username
-            )
-        )[0]
+        images = self.get_images(
+            verified, need_training, index, 1, transform, split, username, after
+        )
+        return next(images, None)
+
+    def get_entries(self, image_ids):
+        return {
+            int(key): entry for key, entry in self.data_dict.get_many(image_ids).items()
+        }
+
+    def _page(self, verified, need_training, start, amount, split, username, after):
+        with self.lock:
+            scope = self._scope(split, username)
+            if (verified, need_training) == (None, None):
+                index = self.index
+            else:
+                index = self.tabs[(verified, need_training)]
+            return index.page(start, amount, after, **scope)
 
     def get_images(
         self,
@@ -391,55 +1881,105 @@ class Database:
         transform=None,
         split=None,
         username=None,
+        after=None,
     ):
-        entries = self._get_sorted(split, username)
-
-        if verified is not None:
-            entries = [entry for entry in entries if entry["verified"] == verified]
-
-        if need_training is not None:
-            entries = [
-                entry for entry in entries if entry["need_training"] == need_training
-            ]
-
-        for entry in itertools.islice(entries, start, start + amount):
+        page = self._page(
+            verified, need_training, start, amount, split, username, after
+        )
+        entries = self.data_dict.get_many(page)
+        for image_id in page:
+            entry = entries.get(str(image_id))
+            # a verdict given since the page was taken moved it to another tab
+            if entry is None or (verified, need_training) not in (
+                (None, None),
+                (entry["verified"], entry["need_training"]),
+            ):
+                continue
             if transform is not None:
                 entry = transform(entry)
             yield entry
 
-    def add_image(self, **fields):
-        new_image_id = str(
-            max([int(id) for id in self.image_ids]) + 1 if self.image_ids else 1
-        )
+    def prefetch(
+        self,
+        verified=None,
+        need_training=None,
+        amount=9,
+        split=None,
+        username=None,
+        after=None,
+    ):
+        # loads the page after `after` into the entry cache, returns its
+        # (image_id, image) pairs and how many entries came from the store
+        page = self._page(verified, need_training, 0, amount, split, username, after)
+        loaded = len(page) - self.data_dict.cached(page)
+        entries = self.data_dict.get_many(page)
+        images = [(int(key), entry.get("image")) for key, entry in entries.items()]
+        return images, loaded
+
+    def next_image_id(self):
+        return self.data_dict.next_id()
+
+    def add_image(self, image_id=None, **fields):
+        # the id may have been reserved with next_image_id() beforehand
+        new_image_id = str(image_id or self.data_dict.next_id())
         fields["image_id"] = int(new_image_id)
         self.data_dict.update({new_image_id: fields})
-        self.data_dict.move_to_end(new_image_id, last=False)
-        self.image_ids.insert(0, new_image_id)
+        with self.lock:
+            self.data_dict.move_to_end(new_image_id, last=False)
+            self._track(None, _counted_fields(fields))
         self.dirty = True
         return new_image_id
 
     def update_image(self, image_id, **fields):
-        existing = self.data_dict[image_id]
-        existing.update(fields)
-        # make sure we trigger the setter
-        self.data_dict[image_id] = existing
+        with self.lock:
+            before = _counted_fields(self.data_dict[image_id])
+            existing = self.data_dict.update_entry(image_id, **fields)
+            self._track(before, _counted_fields(existing))
+        if "image" in fields:
+            self.thumbnails.invalidate(image_id)
 
-        print(f"Updated image {self.data_dict[image_id]}")
+        print(f"Updated image {existing}")
 
+        # written outside of the lock
+        self.data_dict.flush_if_due()
         self.dirty = True
 
-    async def sync(self):
-        while True:
-            await asyncio.sleep(5)
-            if self.dirty:
-                # with concurrent.futures.ThreadPoolExecutor() as pool:
-                #    loop = asyncio.get_running_loop()
-                #    await loop.run_in_executor(pool, self.save)
-                self.save()
-                self.dirty = False
+    def update_images(self, updates):
+        # applies {image_id: fields} together and commits them in a single
+        # transaction. Returns the ids that do not exist, nothing is changed
+        # unless there are none.
+        keys = [str(image_id) for image_id in updates]
+        # loaded first so the lock is not held during the reads
+        entries = self.data_dict.get_many(keys)
+        missing = [
+            image_id for image_id, key in zip(updates, keys) if key not in entries
+        ]
+        if missing:
+            return missing
+        batch = dict(zip(keys, updates.values()))
+        # committed before memory changes so a failed commit leaves nothing
+        # to undo, a poll waits for the batch to be in memory
+        with self.data_dict.write_lock:
+            previous, written = self.data_dict.write_entries(batch)
+            with self.lock, self.data_dict.lock:
+                for key, fields in batch.items():
+                    before, existing = self.data_dict.take_written(
+                        key, previous[key], written[key], fields
+                    )
+                    self._track(before, _counted_fields(existing))
+        for image_id, fields in updates.items():
+            if "image" in fields:
+                self.thumbnails.invalidate(image_id)
+
+        print(f"Updated images {', '.join(keys)}")
+
+        self.dirty = True
+        return []
 
     def set_feedback(self, image_id, feedback):
         self.data_dict.set_feedback(image_id, feedback)
+        with self.lock:
+            self.version += 1
 
     def get_feedback(self, image_ids):
         return self.data_dict.get_feedback(image_ids)
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import threading
+
+
+class EventBroadcaster:
+    # Pushes the database changes to the /events clients. The changes are
+    # recorded from the writer thread and handed to the event loop once per
+    # burst, where they are serialized a single time and the same bytes are
+    # queued to every client along with one snapshot of the counters. A
+    # client that falls `max_queue` messages behind is disconnected, its
+    # EventSource reconnects and reloads what it shows.
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self.loop = None
+        self.db = None
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.event_id = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self, loop, db):
+        self.loop = loop
+        self.db = db
+        db.listeners.append(self.record)
+
+    def stop(self):
+        if self.db is not None:
+            self.db.listeners.remove(self.record)
+        for queue in list(self.clients):
+            self._close(queue)
+
+    def subscribe(self):
+        queue = asyncio.Queue(self.max_queue)
+        self.clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.clients.discard(queue)
+
+    def record(self, before, after):
+        # called with the database lock held, only queues the change
+        if not self.clients:
+            return
+        if after is None:
+            event = {"type": "removed", "image_id": before["image_id"]}
+        elif before is None:
+            event = {
+                "type": "added",
+                "image_id": after["image_id"],
+                "added_by": after["added_by"],
+                "verified": after["verified"],
+                "need_training": after["need_training"],
+            }
+        elif (before["verified"], before["need_training"]) != (
+            after["verified"],
+            after["need_training"],
+        ):
+            event = {
+                "type": "image",
+                "image_id": after["image_id"],
+                "verified": after["verified"],
+                "need_training": after["need_training"],
+            }
+        else:
+            event = None
+        with self.lock:
+            self.pending.append(event)
+            if len(self.pending) > 1:
+                return
+        self.loop.call_soon_threadsafe(self._flush)
+
+    def _message(self, kind, data):
+        self.event_id += 1
+        data = json.dumps(data, separators=(",", ":"))
+        return f"id: {self.event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+    def _flush(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+        chunks = [
+            self._message(event.pop("type"), event)
+            for event in events
+            if event is not None
+        ]
+        counters = self.db.counters
+        chunks.append(
+            self._message(
+                "counters",
+                {
+                    "total": counters.size,
+                    "verified": counters.verified,
+                    "need_training": counters.need_training,
+                    "to_verify": counters.to_verify,
+                },
+            )
+        )
+        message = "".join(chunks).encode()
+        for queue in list(self.clients):
+            if queue.full():
+                self.dropped += 1
+                self._close(queue)
+            else:
+                queue.put_nowait(message)
+        self.sent += len(chunks)
+
+    def _close(self, queue):
+        self.clients.discard(queue)
+        # None tells the handler to end the response, it always fits
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
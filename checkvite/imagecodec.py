@@ -0,0 +1,196 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+# name -> (PIL format, file extension, content type)
+CODECS = {
+    "png": ("PNG", ".png", "image/png"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+}
+DEFAULT_QUALITY = {"jpeg": 90, "webp": 85}
+
+
+class Codec:
+    def __init__(self, name, quality=None):
+        self.name = name
+        self.format, self.extension, self.content_type = CODECS[name]
+        self.quality = quality or DEFAULT_QUALITY.get(name)
+
+    def __repr__(self):
+        return f"Codec({self.spec!r})"
+
+    @property
+    def spec(self):
+        return f"{self.name}:{self.quality}" if self.quality else self.name
+
+    def encode(self, image, target):
+        options = {"quality": self.quality} if self.quality else {}
+        if self.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(target, format=self.format, **options)
+
+    def to_bytes(self, image):
+        stream = BytesIO()
+        self.encode(image, stream)
+        return stream.getvalue()
+
+
+def get_codec(spec="png"):
+    # "png", "jpeg:85", "webp:80"...
+    name, _, quality = spec.lower().partition(":")
+    name = {"jpg": "jpeg"}.get(name, name)
+    if name not in CODECS:
+        raise ValueError(f"Unknown image codec {spec}")
+    if name == "png":
+        return Codec(name)
+    return Codec(name, int(quality) if quality else None)
+
+
+def codec_for_path(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".jpeg":
+        extension = ".jpg"
+    for name, (_, codec_extension, _) in CODECS.items():
+        if extension == codec_extension:
+            return Codec(name)
+    return Codec("png")
+
+
+def _accepted(accept):
+    ranges = []
+    for part in accept.split(","):
+        media_range, *params = [item.strip() for item in part.split(";")]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media_range.lower(), quality))
+    return ranges
+
+
+def _quality(ranges, content_type):
+    # the most specific matching range decides, as in RFC 9110
+    main_type = content_type.split("/")[0]
+    best = None
+    for media_range, quality in ranges:
+        if media_range == content_type:
+            specificity = 2
+        elif media_range == f"{main_type}/*":
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+        if best is None or specificity > best[0]:
+            best = (specificity, quality)
+    return best[1] if best else 0.0
+
+
+def negotiate(accept, stored):
+    # the stored codec wins whenever the client takes it, the file is then
+    # sent as is. Returns None when no codec is acceptable.
+    if not accept:
+        return stored
+    ranges = _accepted(accept)
+    if _quality(ranges, stored.content_type) > 0:
+        return stored
+    candidates = [
+        (_quality(ranges, CODECS[name][2]), name)
+        for name in CODECS
+        if name != stored.name
+    ]
+    quality, name = max(candidates)
+    return Codec(name) if quality > 0 else None
+
+
+def transcode(image_path, codec):
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        return codec.to_bytes(image)
+
+
+def _reencode(job):
+    from PIL import Image
+
+    key, image_path, codec, store, thumbnails = job
+    try:
+        with Image.open(image_path) as image:
+            new_path = store.put_image(image, codec)
+            if thumbnails is not None:
+                thumbnails.invalidate(key)
+                thumbnails.render(key, new_path, image)
+    except (OSError, ValueError) as e:
+        return key, None, str(e)
+    return key, new_path, None
+
+
+def migrate(data_dict, codec, thumbnails=None, workers=None, batch_size=500):
+    # re-encodes the stored images that do not use `codec`. The old files
+    # are released, the store removes them once no committed entry points
+    # to them.
+    from tqdm import tqdm
+
+    jobs = []
+    for key, entry in data_dict.items():
+        image_path = entry.get("image")
+        if not isinstance(image_path, str) or not os.path.exists(image_path):
+            continue
+        if codec_for_path(image_path).name != codec.name:
+            jobs.append((key, image_path, codec, data_dict.store, thumbnails))
+    errors = []
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(_reencode, jobs, chunksize=16)
+        for i, (key, new_path, error) in enumerate(
+            tqdm(results, total=len(jobs), desc=f"Re-encoding as {codec.spec}")
+        ):
+            if error is not None:
+                errors.append(f"{key}: {error}")
+                continue
+            data_dict.update_entry(key, image=new_path)
+            if (i + 1) % batch_size == 0:
+                data_dict.sync()
+        data_dict.sync()
+    return len(jobs), errors
+
+
+def main():
+    from checkvite.db import PersistentOrderedDict
+    from checkvite.thumbnails import ThumbnailStore
+    from checkvite.serve import CONFIG
+
+    parser = argparse.ArgumentParser(
+        description="Re-encode the stored images, run it with the server stopped."
+    )
+    parser.add_argument(
+        "codec", help="Target codec: png, jpeg[:quality], webp[:quality]"
+    )
+    parser.add_argument("--filename", default="alt-text")
+    parser.add_argument("--image-dir", default="images")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    codec = get_codec(args.codec)
+    data_dict = PersistentOrderedDict(
+        args.filename, image_dir=args.image_dir, lazy=True
+    )
+    thumbnails = ThumbnailStore(
+        args.image_dir, CONFIG.get("thumbnail_sizes", [100]), codec=codec
+    )
+    converted, errors = migrate(data_dict, codec, thumbnails, args.workers)
+    for error in errors:
+        print(f"Failed to re-encode {error}")
+    print(f"Re-encoded {converted - len(errors)} images as {codec.spec}")
+    data_dict.conn.close()
+
+
+if __name__ == "__main__":
+    main()
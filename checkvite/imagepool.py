@@ -0,0 +1,120 @@
+import asyncio
+import functools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from checkvite import profiler
+from checkvite.metrics import Histogram
+
+# upper bounds of the task duration histogram, in seconds
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, float("inf"))
+
+
+class PoolOverloaded(Exception):
+    pass
+
+
+class ImagePool:
+    # Shared process pool for the PIL work of the request path. At most
+    # `max_queue` tasks are queued or running, past that (or when a task
+    # takes longer than `timeout`) PoolOverloaded is raised and the request
+    # answered with a 503 instead of waiting behind everybody else.
+    def __init__(self, workers=None, max_queue=32, timeout=30.0):
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.duration_sum = 0.0
+        self.duration_max = 0.0
+        self.duration_buckets = [0] * len(DURATION_BUCKETS)
+        # the decoding and encoding work of the requests, by task
+        self.tasks = Histogram(
+            "checkvite_image_task_seconds",
+            "Time from submission to the end of an image pool task.",
+            ("task",),
+        )
+
+    def _done(self, task, start, future):
+        # called from the executor thread when the worker is done, including
+        # after a timeout, so `depth` counts the real load on the workers
+        duration = time.perf_counter() - start
+        with self.lock:
+            self.depth -= 1
+            if future.cancelled():
+                return
+            self.completed += 1
+            self.tasks.observe(duration, task)
+            self.duration_sum += duration
+            self.duration_max = max(self.duration_max, duration)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    self.duration_buckets[i] += 1
+                    break
+
+    async def run(self, func, *args, **kwargs):
+        with self.lock:
+            if self.depth >= self.max_queue:
+                self.rejected += 1
+                raise PoolOverloaded(f"{self.depth} image tasks queued")
+            self.depth += 1
+        call = functools.partial(func, *args, **kwargs)
+        profiled = profiler.current.get()
+        if profiled is not None:
+            call = functools.partial(profiler.sample_call, profiled[0].interval, call)
+        future = self.executor.submit(call)
+        task = getattr(func, "__qualname__", type(func).__name__)
+        future.add_done_callback(
+            functools.partial(self._done, task, time.perf_counter())
+        )
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            raise PoolOverloaded(f"image task took more than {self.timeout}s")
+        if profiled is None:
+            return result
+        result, stacks = result
+        profiled[0].add(profiled[1], stacks)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": self.depth,
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "duration_sum": self.duration_sum,
+                "duration_max": self.duration_max,
+                "duration_buckets": dict(
+                    zip(map(str, DURATION_BUCKETS), self.duration_buckets)
+                ),
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def encode_upload(data, key, codec, store, thumbnails=None):
+    # decodes an uploaded image, stores it with the codec unless the same
+    # image is already stored, and renders its thumbnails
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert("RGB")
+    image_path = store.put_image(image, codec)
+    if thumbnails is not None:
+        thumbnails.render(key, image_path, image)
+    return image_path
@@ -0,0 +1,75 @@
+import os
+import hashlib
+import shutil
+import threading
+
+
+class ImageStore:
+    # Content-addressed image files: <image_dir>/ab/cd/abcd...<ext>, named
+    # after the SHA-256 of the encoded bytes. Identical images are stored
+    # once, entries point to the file and it is removed by the database
+    # when no entry references it anymore.
+    def __init__(self, image_dir):
+        self.image_dir = image_dir
+        os.makedirs(self.image_dir, exist_ok=True)
+
+    def path(self, digest, extension):
+        return os.path.join(
+            self.image_dir, digest[:2], digest[2:4], f"{digest}{extension}"
+        )
+
+    def owns(self, path):
+        root = os.path.abspath(self.image_dir)
+        return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+    def is_sharded(self, path):
+        shard = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+        return os.path.abspath(shard) == os.path.abspath(self.image_dir)
+
+    def put(self, data, extension):
+        path = self.path(hashlib.sha256(data).hexdigest(), extension)
+        # an exact duplicate is already there, nothing to write
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        return path
+
+    def put_image(self, image, codec):
+        return self.put(codec.to_bytes(image), codec.extension)
+
+    def adopt(self, path):
+        # hard links a file stored elsewhere into the store, the caller
+        # removes the original once nothing points to it anymore
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        target = self.path(digest.hexdigest(), os.path.splitext(path)[1].lower())
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(path, target)
+            except FileExistsError:
+                pass
+            except OSError:
+                shutil.copy2(path, target)
+        return target
+
+    def flat_files(self):
+        with os.scandir(self.image_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    yield entry.path
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        shutil.rmtree(self.image_dir, ignore_errors=True)
+        os.makedirs(self.image_dir, exist_ok=True)
@@ -0,0 +1,350 @@
+import os
+import sys
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+from cryptography import fernet
+
+from checkvite.bench import REASONS, add_annotators, create_database
+
+# how an annotator session spreads its page fetches over the tabs
+TAB_WEIGHTS = {"to_verify": 0.7, "to_train": 0.2, "verified": 0.1}
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(ordered, p):
+    # nearest rank of a sorted list
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Recorder:
+    # latencies per endpoint, a request answered with an error status or
+    # failing on the connection counts as an error and not as a latency
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, session, endpoint, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as resp:
+                body = await resp.read()
+        except aiohttp.ClientError:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None, None, None
+        if resp.status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        else:
+            self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        return resp.status, resp.headers, body
+
+    def summary(self, duration):
+        endpoints = {}
+        everything = []
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies.get(endpoint, []))
+            everything.extend(latencies)
+            endpoints[endpoint] = self._summary(
+                latencies, self.errors.get(endpoint, 0), duration
+            )
+        endpoints["all"] = self._summary(
+            sorted(everything), sum(self.errors.values()), duration
+        )
+        return endpoints
+
+    @staticmethod
+    def _summary(latencies, errors, duration):
+        result = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / duration,
+        }
+        if latencies:
+            result["mean_ms"] = sum(latencies) / len(latencies) * 1000
+            for p in PERCENTILES:
+                result[f"p{p}_ms"] = percentile(latencies, p) * 1000
+            result["max_ms"] = latencies[-1] * 1000
+        return result
+
+
+def write_images(path, size):
+    # one small PNG behind every synthetic entry, hard links of the same file
+    # so even large datasets are quick to set up, the thumbnails are still
+    # rendered per image
+    from PIL import Image
+
+    image_dir = os.path.join(path, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    source = os.path.join(path, "source.png")
+    Image.new("RGB", (320, 240), (90, 120, 150)).save(source)
+    for image_id in range(1, size + 1):
+        target = os.path.join(image_dir, f"{image_id}.png")
+        try:
+            os.link(source, target)
+        except OSError:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                dst.write(src.read())
+
+
+async def annotator(server, recorder, username, options, rng, password="bench"):
+    # login, then pages of the tabs with their thumbnails, a verdict on one
+    # image of each page (on all of them with --bulk) and a /stats poll
+    # every few pages
+    url = server.make_url
+    cursors = {}
+    etag = None
+    jar = aiohttp.CookieJar(unsafe=True)
+    async with aiohttp.ClientSession(cookie_jar=jar) as session:
+        await recorder.request(
+            session,
+            "POST /login",
+            "POST",
+            url("/login"),
+            data={"username": username, "password": password},
+            allow_redirects=False,
+        )
+        for i in range(options.rounds):
+            tab = rng.choices(list(TAB_WEIGHTS), list(TAB_WEIGHTS.values()))[0]
+            params = {"tab": tab, "cursor": cursors.get(tab, "")}
+            embed = rng.random() < options.embed
+            if embed:
+                params["thumbnails"] = "1"
+            status, _, body = await recorder.request(
+                session,
+                "GET /get_images?thumbnails=1" if embed else "GET /get_images",
+                "GET",
+                url("/get_images"),
+                params=params,
+            )
+            page = json.loads(body) if status == 200 else {"images": []}
+            images = page["images"]
+            # back to the first page once the end of the tab is reached
+            cursors[tab] = page["cursor"] if images else ""
+
+            if images and not embed:
+                await recorder.request(
+                    session,
+                    "GET /thumbnails",
+                    "GET",
+                    url("/thumbnails"),
+                    params={
+                        "image_ids": ",".join(
+                            str(image["image_id"]) for image in images
+                        )
+                    },
+                )
+            if i % options.stats_every == 0:
+                status, headers, _ = await recorder.request(
+                    session,
+                    "GET /stats",
+                    "GET",
+                    url("/stats"),
+                    headers={"If-None-Match": etag} if etag else {},
+                )
+                if status == 200:
+                    etag = headers.get("ETag")
+            if options.think:
+                await asyncio.sleep(rng.expovariate(1 / options.think))
+            if images and options.bulk:
+                # the verdicts of the whole page in one request
+                await recorder.request(
+                    session,
+                    "POST /verdicts",
+                    "POST",
+                    url("/verdicts"),
+                    json={
+                        "verdicts": [
+                            {
+                                "image_id": image["image_id"],
+                                "action": rng.choice(["validate", "train"]),
+                                "caption": "",
+                                "rejection_reasons": [rng.choice(REASONS)],
+                            }
+                            for image in images
+                        ]
+                    },
+                )
+            elif images:
+                await recorder.request(
+                    session,
+                    "POST /train",
+                    "POST",
+                    url("/train"),
+                    data={
+                        "image_id": str(rng.choice(images)["image_id"]),
+                        "action": rng.choice(["validate", "train"]),
+                        "caption": "",
+                        "rejection_reason": rng.choice(REASONS),
+                    },
+                    allow_redirects=False,
+                )
+
+
+async def run_load(size, options):
+    from checkvite import serve
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        db = create_database(path, size)
+        write_images(path, size)
+        # the entries point to images/<id>.png, relative to the server
+        os.chdir(path)
+        try:
+            app = serve.create_app(
+                db, secret_key=fernet.Fernet(fernet.Fernet.generate_key())
+            )
+            names = add_annotators(options.annotators)
+            server = TestServer(app)
+            await server.start_server()
+            recorder = Recorder()
+            try:
+                start = time.perf_counter()
+                await asyncio.gather(
+                    *[
+                        annotator(
+                            server,
+                            recorder,
+                            name,
+                            options,
+                            random.Random(f"{options.seed}-{name}"),
+                        )
+                        for name in names
+                    ]
+                )
+                duration = time.perf_counter() - start
+            finally:
+                await server.close()
+        finally:
+            os.chdir(cwd)
+    return {"size": size, "duration": duration, "endpoints": recorder.summary(duration)}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, annotators):
+    endpoints = result["endpoints"]
+    print(
+        f"\n{result['size']} images, {annotators} annotators, "
+        f"{endpoints['all']['requests']} requests in {result['duration']:.2f}s"
+    )
+    columns = ["requests", "errors", "req/s"] + [f"p{p} ms" for p in PERCENTILES]
+    print(f"{'endpoint':<30}" + "".join(f"{column:>10}" for column in columns))
+    for endpoint, stats in endpoints.items():
+        values = [f"{stats['requests']:>10}", f"{stats['errors']:>10}"]
+        values.append(f"{stats['throughput']:>10.1f}")
+        for p in PERCENTILES:
+            value = stats.get(f"p{p}_ms")
+            values.append(f"{value:>10.2f}" if value is not None else f"{'-':>10}")
+        print(f"{endpoint:<30}" + "".join(values))
+
+
+def compare(results, baseline_path):
+    # p50 and p95 of this run against a saved one, for the sizes and
+    # endpoints both have
+    with open(baseline_path) as f:
+        baseline = {
+            result["size"]: result["endpoints"] for result in json.load(f)["results"]
+        }
+    print(f"\nCompared to {baseline_path} (new / old)")
+    for result in results:
+        old = baseline.get(result["size"])
+        if old is None:
+            continue
+        print(f"{result['size']} images")
+        for endpoint, stats in result["endpoints"].items():
+            if "p50_ms" not in stats or "p50_ms" not in old.get(endpoint, {}):
+                continue
+            ratios = [
+                f"p{p} {stats[f'p{p}_ms'] / old[endpoint][f'p{p}_ms']:.2f}x"
+                for p in (50, 95)
+            ]
+            print(f"  {endpoint:<30}" + "  ".join(ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive annotator sessions against an in-process server on "
+        "synthetic datasets and report the latency per endpoint."
+    )
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--annotators", type=int, default=8)
+    parser.add_argument(
+        "--rounds", type=int, default=50, help="Pages fetched by each annotator."
+    )
+    parser.add_argument(
+        "--embed",
+        type=float,
+        default=0.5,
+        help="Share of the pages fetched with their thumbnails embedded, the "
+        "others load them from /thumbnails.",
+    )
+    parser.add_argument(
+        "--stats-every", type=int, default=5, help="Poll /stats every N pages."
+    )
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=0.0,
+        help="Mean pause in seconds before each verdict.",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Post the verdicts of each page to /verdicts instead of one "
+        "verdict to /train.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to that file.")
+    parser.add_argument("--compare", help="A results file of an earlier run.")
+    options = parser.parse_args()
+
+    results = []
+    for size in [int(size) for size in options.sizes.split(",")]:
+        result = asyncio.run(run_load(size, options))
+        print_result(result, options.annotators)
+        results.append(result)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(
+                {
+                    "date": datetime.now().isoformat(),
+                    "revision": git_revision(),
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "options": vars(options),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if options.compare:
+        compare(results, options.compare)
+    errors = sum(result["endpoints"]["all"]["errors"] for result in results)
+    raise SystemExit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import bisect
+import threading
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    # Prometheus histogram with a series per combination of label values,
+    # observed from any thread
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # label values -> [count per bucket..., count above, sum]
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            # the last slot before the sum counts the values above all bounds
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted(self.series.items())
+            series = [(labels, list(values)) for labels, values in series]
+        for labels, values in series:
+            count = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), values):
+                count += bucket
+                le = _labels(self.labels + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {count}")
+            label_text = _labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {values[-1]}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+def sample(name, kind, help, values, labels=()):
+    # lines of a counter or gauge read from the existing stats, `values`
+    # is a number or a dict of label values -> number
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    if not isinstance(values, dict):
+        values = {(): values}
+    for label_values, value in sorted(values.items()):
+        if not isinstance(label_values, tuple):
+            label_values = (label_values,)
+        lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return lines
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+from collections import OrderedDict
+
+
+class Prefetcher:
+    # Loads the page that follows the one just served while the annotator
+    # works on it: its entries go to the entry cache and its missing
+    # thumbnails are rendered. At most `max_tasks` prefetches run at once
+    # and one per session, past that they are skipped. The served images
+    # are checked against the prefetched ones for the hit rate.
+    def __init__(self, max_tasks=2, max_tracked=10000):
+        self.max_tasks = max_tasks
+        self.max_tracked = max_tracked
+        self.running = {}
+        # ids loaded ahead and not served yet, oldest first
+        self.prefetched = OrderedDict()
+        self.scheduled = 0
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.entries = 0
+        self.thumbnails = 0
+        self.hits = 0
+        self.misses = 0
+
+    def schedule(self, session, job):
+        # `job` is a coroutine function returning the prefetched ids, the
+        # number of entries read from the store and of thumbnails rendered
+        if session in self.running or len(self.running) >= self.max_tasks:
+            self.skipped += 1
+            return
+        self.scheduled += 1
+        task = asyncio.create_task(job())
+        self.running[session] = task
+        task.add_done_callback(functools.partial(self._done, session))
+
+    def _done(self, session, task):
+        del self.running[session]
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            self.failed += 1
+            print(f"Prefetch failed: {task.exception()!r}")
+            return
+        image_ids, entries, thumbnails = task.result()
+        self.completed += 1
+        self.entries += entries
+        self.thumbnails += thumbnails
+        for image_id in image_ids:
+            self.prefetched[image_id] = True
+            self.prefetched.move_to_end(image_id)
+        while len(self.prefetched) > self.max_tracked:
+            self.prefetched.popitem(last=False)
+
+    def served(self, image_ids):
+        for image_id in image_ids:
+            if self.prefetched.pop(image_id, None):
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        served = self.hits + self.misses
+        return {
+            "running": len(self.running),
+            "max_tasks": self.max_tasks,
+            "scheduled": self.scheduled,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "entries_loaded": self.entries,
+            "thumbnails_rendered": self.thumbnails,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / served if served else None,
+        }
+
+    async def close(self):
+        tasks = list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,185 @@
+import os
+import sys
+import asyncio
+import contextvars
+import functools
+import random
+import threading
+import time
+from collections import Counter
+
+# (profiler, label) while a profiled request runs, copied into the threads
+# and image pool tasks that work for it
+current = contextvars.ContextVar("checkvite_profiled", default=None)
+
+
+def frame_name(code):
+    return (
+        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    )
+
+
+def collapse(frame, root, until=None):
+    # root first, the way flamegraph.pl and speedscope read them, the frames
+    # from `until` up are left out
+    names = []
+    while frame is not None and frame.f_code is not until:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+
+def sample_call(interval, func):
+    # runs `func` in an image pool worker while a thread samples it, returns
+    # its result and the stacks seen
+    ident = threading.get_ident()
+    until = sys._getframe().f_code
+    stacks = Counter()
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            frame = sys._current_frames().get(ident)
+            if frame is not None:
+                stacks[collapse(frame, "image pool", until)] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        return func(), stacks
+    finally:
+        done.set()
+        sampler.join()
+
+
+def run_tagged(profiler, label, func):
+    # runs a database call for a profiled request, its thread is sampled
+    ident = threading.get_ident()
+    profiler.threads[ident] = label
+    try:
+        return func()
+    finally:
+        profiler.threads.pop(ident, None)
+
+
+class Profiler:
+    # Statistical profiler of live requests. While a window is open a thread
+    # samples the stack of the event loop when a profiled request is the
+    # running task, and of the database threads working for one. The image
+    # pool tasks of these requests sample themselves in the worker. The
+    # stacks are aggregated under "<method> <route>" in the collapsed
+    # format. Closed, it costs the requests one attribute check.
+    def __init__(self, max_stacks=20000):
+        self.max_stacks = max_stacks
+        self.active = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.sampler = None
+        self.loop = None
+        self.loop_thread = None
+        self.route = None
+        self.fraction = 1.0
+        self.interval = 0.005
+        self.started = None
+        self.deadline = None
+        # asyncio task -> label of the profiled requests, thread ident ->
+        # label of the threads running a database call for one
+        self.tasks = {}
+        self.threads = {}
+        self.stacks = Counter()
+        self.requests = 0
+        self.samples = 0
+        self.dropped = 0
+
+    def start(self, seconds, route=None, fraction=1.0, interval=0.005):
+        # a new window drops the samples of the previous one
+        self.stop()
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.route = route
+        self.fraction = fraction
+        self.interval = interval
+        self.started = time.time()
+        self.deadline = time.monotonic() + seconds
+        self.stacks = Counter()
+        self.requests = self.samples = self.dropped = 0
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(
+            target=self._sample, name="checkvite-profiler", daemon=True
+        )
+        self.active = True
+        self.sampler.start()
+
+    def stop(self):
+        self.active = False
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def label(self, request):
+        # None when the request is not profiled
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        if self.route is not None and route != self.route:
+            return None
+        if self.fraction < 1 and random.random() >= self.fraction:
+            return None
+        self.requests += 1
+        return f"{request.method} {route}"
+
+    def in_thread(self, label, func):
+        return functools.partial(run_tagged, self, label, func)
+
+    def add(self, label, stacks):
+        with self.lock:
+            for stack, count in stacks.items():
+                self._count(f"{label};{stack}", count)
+
+    def _count(self, stack, count=1):
+        if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+            self.dropped += count
+            return
+        self.stacks[stack] += count
+        self.samples += count
+
+    def _sample(self):
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() >= self.deadline:
+                break
+            frames = sys._current_frames()
+            until = run_tagged.__code__
+            sampled = [(ident, label, until) for ident, label in self.threads.items()]
+            label = self.tasks.get(asyncio.current_task(self.loop))
+            if label is not None:
+                sampled.append((self.loop_thread, label, None))
+            with self.lock:
+                for ident, label, until in sampled:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self._count(collapse(frame, label, until))
+        self.active = False
+
+    def collapsed(self):
+        with self.lock:
+            return "".join(
+                f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+            )
+
+    def stats(self):
+        remaining = None
+        if self.active:
+            remaining = max(0.0, self.deadline - time.monotonic())
+        return {
+            "active": self.active,
+            "route": self.route,
+            "fraction": self.fraction,
+            "interval": self.interval,
+            "started": self.started,
+            "remaining": remaining,
+            "requests": self.requests,
+            "samples": self.samples,
+            "dropped": self.dropped,
+            "stacks": len(self.stacks),
+        }
@@ -1,26 +1,51 @@
-from io import BytesIO
 import os
 import asyncio
 import argparse
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
 import json
 import hashlib
+import base64
+import binascii
+import time
+from datetime import datetime
 
-from PIL import Image as PILImage
 from aiohttp_session import setup, get_session, new_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
-from aiohttp import web
+from aiohttp import web, MultipartWriter
 import aiohttp_jinja2
 import jinja2
+from cryptography import fernet
 
-from checkvite.db import Database
+from checkvite.db import Database, TABS
+from checkvite.aiodb import AsyncDatabase
+from checkvite.events import EventBroadcaster
+from checkvite.prefetch import Prefetcher
+from checkvite.imagepool import ImagePool, PoolOverloaded, encode_upload
+from checkvite.imagecodec import codec_for_path, negotiate, transcode
+from checkvite.metrics import Histogram, sample
+from checkvite.profiler import Profiler, current as current_profile
 
 SECRET_KEY = "DUMMY_KEY_CHANGE_ME"
 HERE = os.path.dirname(__file__)
-db = Database()
 routes = web.RouteTableDef()
 PRODUCTION = False
 USERS_FILE = os.path.join(HERE, "users.json")
 CONFIG = json.load(open(os.path.join(HERE, "config.json")))
+# an image URL keeps its id when update_entry or imagecodec.migrate swap the
+# file, so clients revalidate every time and get a 304 while the ETag holds
+IMAGE_CACHE_CONTROL = "public, no-cache"
+# upper bound of the thumbnails sent in one /thumbnails response
+MAX_THUMBNAILS = 200
+# seconds between two keep-alive comments on an idle /events stream
+EVENTS_HEARTBEAT = 15
+# upper bound of the verdicts applied by one /verdicts request
+MAX_VERDICTS = 100
+# longest profiling window, the samples are kept in memory
+MAX_PROFILE_SECONDS = 600
 
 
 class UserNotFoundError(Exception):
@@ -96,6 +121,64 @@ async def handle_logout(request):
     raise web.HTTPFound("/")
 
 
+@web.middleware
+async def overload_middleware(request, handler):
+    try:
+        return await handler(request)
+    except PoolOverloaded as e:
+        print(f"Rejected {request.path}: {e}")
+        raise web.HTTPServiceUnavailable(
+            text="The server is busy, try again shortly.",
+            headers={"Retry-After": "1"},
+        )
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    # latency per route and status, the rejected requests included
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        # the client went away
+        status = 499
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        request.app["requests"].observe(
+            time.perf_counter() - start,
+            request.method,
+            resource.canonical if resource is not None else "unmatched",
+            str(status),
+        )
+
+
+@web.middleware
+async def profile_middleware(request, handler):
+    profiler = request.app["profiler"]
+    if not profiler.active:
+        return await handler(request)
+    label = profiler.label(request)
+    if label is None:
+        return await handler(request)
+    # the handler runs in this task, the database calls and image pool
+    # tasks it makes pick the profile up from the context
+    task = asyncio.current_task()
+    profiler.tasks[task] = label
+    current_profile.set((profiler, label))
+    try:
+        return await handler(request)
+    finally:
+        profiler.tasks.pop(task, None)
+        current_profile.set(None)
+
+
 @web.middleware
 async def auth_middleware(request, handler):
     session = await get_session(request)
@@ -103,84 +186,335 @@ async def auth_middleware(request, handler):
     return await handler(request)
 
 
-@routes.get("/stats")
-async def stats_handler(request):
-    session = await get_session(request)
-    username = session.get("username", None)
-    if db.verified == 0 or db.need_training == 0:
+class StatsCache:
+    # /stats bodies per user for the current data version, the ETag is
+    # derived from the version alone so an unchanged poll is answered with
+    # a 304 before any counter is read
+    def __init__(self):
+        self.bodies = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def etag(version, username):
+        user = hashlib.sha1(str(username).encode()).hexdigest()[:12]
+        return f'"{"-".join(str(part) for part in version)}-{user}"'
+
+    def get(self, version, username):
+        cached = self.bodies.get(username)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        return None
+
+    def put(self, version, username, body):
+        self.bodies[username] = (version, body)
+
+    def stats(self):
+        return {
+            "users": len(self.bodies),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+        }
+
+
+async def compute_stats(db, username):
+    counters = db.counters
+    verified, need_training = counters.verified, counters.need_training
+    if verified == 0 or need_training == 0:
         acceptance_rate = 0
     else:
-        acceptance_rate = db.verified / (db.verified + db.need_training) * 100
+        acceptance_rate = verified / (verified + need_training) * 100
 
     response_data = {
-        "need_training": db.need_training,
-        "verified": db.verified,
-        "to_verify": db.to_verify,
+        "need_training": need_training,
+        "verified": verified,
+        "to_verify": counters.to_verify,
         "acceptance_rate": "%.2f" % acceptance_rate,
         "u_need_training": 0,
         "u_verified": 0,
         "u_to_verify": 0,
-        "total": db.size,
+        "total": counters.size,
         "total_user": 0,
     }
 
     if username is not None:
         user = get_user(username)
         user_split = user.get_data_split(db.size)
-        response_data.update(db.get_user_stats(user_split, username))
+        response_data.update(await db.get_user_stats(user_split, username))
         response_data["total_user"] = user_split[1] - user_split[0]
 
-    response_data["rejection_reasons"] = db.get_rejection_stats()
-    return web.json_response(response_data)
+    response_data["rejection_reasons"] = await db.get_rejection_stats()
+    return response_data
+
+
+@routes.get("/stats")
+async def stats_handler(request):
+    session = await get_session(request)
+    username = session.get("username", None)
+    db = request.app["db"]
+    cache = request.app["stats_cache"]
+    # read before the counters, a change made meanwhile bumps it again and
+    # the next poll computes the stats anew
+    version = db.version
+    etag = StatsCache.etag(version, username)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        cache.not_modified += 1
+        return web.Response(status=304, headers=headers)
+
+    body = cache.get(version, username)
+    if body is None:
+        body = json.dumps(await compute_stats(db, username))
+        cache.put(version, username, body)
+    return web.Response(text=body, content_type="application/json", headers=headers)
+
+
+@routes.get("/events")
+async def event_stream(request):
+    # Server-Sent Events: "added", "image" (a verdict moved an image to
+    # another tab) and "counters" messages, see EventBroadcaster
+    events = request.app["events"]
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
+    queue = events.subscribe()
+    try:
+        await response.write(b"retry: 2000\n\n")
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # keeps proxies from closing an idle stream
+                message = b": ping\n\n"
+            if message is None:
+                break
+            await response.write(message)
+    except ConnectionResetError:
+        pass
+    finally:
+        events.unsubscribe(queue)
+    return response
+
+
+def image_validators(image_id, entry):
+    # strong validators derived from the entry rather than the file stat
+    modified_date = entry.get("modified_date") or ""
+    digest = hashlib.sha1(
+        f"{image_id}:{modified_date}:{entry['image']}".encode()
+    ).hexdigest()
+    last_modified = None
+    if modified_date:
+        last_modified = datetime.fromisoformat(str(modified_date)).astimezone()
+    return digest[:20], last_modified
+
+
+async def set_image_validators(request, response):
+    # FileResponse fills ETag and Last-Modified from the file stat just
+    # before the headers are sent, we put the entry ones back.
+    validators = request.get("image_validators")
+    if validators is None or response.status != 200:
+        return
+    etag, last_modified = validators
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+
+async def send_image(request, path, etag, last_modified):
+    # the stored file is sent as is with sendfile when the client accepts
+    # its format, otherwise it is transcoded in the image pool.
+    stored = codec_for_path(path)
+    codec = negotiate(request.headers.get("Accept", ""), stored)
+    if codec is None:
+        raise web.HTTPNotAcceptable()
+    if codec.name != stored.name:
+        etag = f"{etag}-{codec.name}"
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "Vary": "Accept"}
+    if_none_match = request.if_none_match
+    if if_none_match and any(tag.value in (etag, "*") for tag in if_none_match):
+        raise web.HTTPNotModified(headers=dict(headers, ETag=f'"{etag}"'))
+    request["image_validators"] = (etag, last_modified)
+    headers["Content-Type"] = codec.content_type
+    if codec.name == stored.name:
+        return web.FileResponse(path, headers=headers)
+    try:
+        body = await request.app["image_pool"].run(transcode, path, codec)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    return web.Response(body=body, headers=headers)
 
 
 @routes.get("/images/{image_id}.png")
 async def get_image(request):
     image_id = int(request.match_info["image_id"])
-    entry = db[image_id]
-    image_path = entry["image"]
-    image = PILImage.open(image_path)
-    stream = BytesIO()
-    image.save(stream, "PNG")
-    return web.Response(body=stream.getvalue(), content_type="image/png")
+    try:
+        entry = await request.app["db"].get_entry(image_id)
+    except KeyError:
+        raise web.HTTPNotFound()
+    etag, last_modified = image_validators(image_id, entry)
+    return await send_image(request, entry["image"], etag, last_modified)
+
+
+def thumbnail_size(request):
+    sizes = request.app["db"].thumbnails.sizes
+    try:
+        size = int(request.query.get("size", sizes[0]))
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid size")
+    if size not in sizes:
+        raise web.HTTPNotFound(text="Unknown thumbnail size")
+    return size
+
+
+async def load_thumbnails(request, images, size):
+    # image_id -> thumbnail bytes for (image_id, image_path) pairs. The fresh
+    # ones are read on the reader pool, the others rendered in one image
+    # pool task.
+    db = request.app["db"]
+    thumbnails = db.thumbnails
+    found = await db.read(thumbnails.read_many, images, size)
+    missing = [(image_id, path) for image_id, path in images if image_id not in found]
+    if missing:
+        found.update(
+            await request.app["image_pool"].run(
+                thumbnails.read_many, missing, size, render=True
+            )
+        )
+    return found
+
+
+def schedule_prefetch(request, session, scope, images, thumbnail_size=None):
+    # loads the page after the one served in the background, with its
+    # thumbnails when they are embedded and the image pool has room
+    if not images:
+        return
+    app = request.app
+    db = app["db"]
+    pool = app["image_pool"]
+    after = images[-1]["image_id"]
+
+    async def job():
+        pairs, loaded = await db.prefetch(after=after, **scope)
+        rendered = 0
+        if thumbnail_size is not None and pairs and pool.depth < pool.max_queue // 2:
+            with contextlib.suppress(PoolOverloaded):
+                rendered = await pool.run(db.thumbnails.warm, pairs, thumbnail_size)
+        return [image_id for image_id, _ in pairs], loaded, rendered
+
+    app["prefetcher"].schedule(session, job)
+
+
+def data_uri(content_type, data):
+    return f"data:{content_type};base64,{base64.b64encode(data).decode()}"
+
+
+@routes.get("/thumbnails")
+async def get_thumbnails(request):
+    # the thumbnails of a whole page in one response, as data URIs in JSON
+    # (`format=data_uri`, the default) or as a multipart/mixed body
+    # (`format=multipart`) with one part per image
+    db = request.app["db"]
+    size = thumbnail_size(request)
+    image_ids = [
+        int(image_id)
+        for image_id in request.query.get("image_ids", "").split(",")
+        if image_id.strip().isdigit()
+    ][:MAX_THUMBNAILS]
+    entries = await db.get_entries(image_ids)
+    found = await load_thumbnails(
+        request,
+        [(image_id, entries[image_id]["image"]) for image_id in entries],
+        size,
+    )
+    content_type = db.thumbnails.codec.content_type
+
+    digest = hashlib.sha1()
+    for image_id in image_ids:
+        digest.update(f"{image_id}:".encode())
+        digest.update(found.get(image_id, b""))
+    etag = digest.hexdigest()[:20]
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL}
+    if_none_match = request.if_none_match
+    if if_none_match and any(tag.value in (etag, "*") for tag in if_none_match):
+        raise web.HTTPNotModified(headers=dict(headers, ETag=f'"{etag}"'))
+
+    if request.query.get("format", "data_uri") == "multipart":
+        body = MultipartWriter("mixed")
+        for image_id in image_ids:
+            if image_id in found:
+                body.append(
+                    found[image_id],
+                    {"Content-Type": content_type, "X-Image-Id": str(image_id)},
+                )
+        response = web.Response(body=body, headers=headers)
+    else:
+        response = web.json_response(
+            {
+                "size": size,
+                "thumbnails": {
+                    str(image_id): data_uri(content_type, found[image_id])
+                    for image_id in image_ids
+                    if image_id in found
+                },
+            },
+            headers=headers,
+        )
+    response.etag = etag
+    return response
 
 
 @routes.get("/images/thumbnail/{image_id}.png")
 async def get_image_thumbnail(request):
     image_id = int(request.match_info["image_id"])
-    entry = db[image_id]
-    image_path = entry["image"]
-    image = PILImage.open(image_path)
-    image.thumbnail((100, 100), resample=PILImage.LANCZOS)
-    stream = BytesIO()
-    image.save(stream, "PNG")
-    return web.Response(body=stream.getvalue(), content_type="image/png")
+    db = request.app["db"]
+    thumbnails = db.thumbnails
+    size = thumbnail_size(request)
+    try:
+        entry = await db.get_entry(image_id)
+    except KeyError:
+        raise web.HTTPNotFound()
+    path = thumbnails.path(image_id, size)
+    if not thumbnails.is_fresh(image_id, size, entry["image"]):
+        # rendered once on first access, then served from disk
+        try:
+            path = await request.app["image_pool"].run(
+                thumbnails.get, image_id, size, entry["image"]
+            )
+        except FileNotFoundError:
+            raise web.HTTPNotFound()
+    # thumbnails are rewritten when they change, the file stat validates them
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    return await send_image(request, path, etag, stat.st_mtime)
 
 
 @routes.get("/get_image")
 async def get_single_image(request):
     session = await get_session(request)
     username = session.get("username", None)
+    db = request.app["db"]
 
     tab = request.query.get("tab", "to_verify")
-    if tab == "to_verify":
-        verified = 0
-        need_training = 0
-    elif tab == "verified":
-        verified = 1
-        need_training = 0
-    elif tab == "check":
-        verified = None
-        need_training = None
-    else:
-        verified = 0
-        need_training = 1
+    verified, need_training = get_tab_filters(tab)
 
     batch = int(request.query.get("batch", 1))
     index = int(request.query.get("index", 0))
     batch_size = int(request.query.get("batch_size", 9))
     index = (batch - 1) * batch_size + index
     user_id = request.query.get("user_id", None)
+    cursor = request.query.get("cursor", None)
 
     if username and username != "admin":
         data_split = get_user(username).get_data_split(db.size)
@@ -189,16 +523,53 @@ async def get_single_image(request):
     else:
         data_split = None
 
-    image = db.get_image(
+    scope = dict(
         verified=verified,
         need_training=need_training,
-        index=index,
-        transform=entry2json,
         split=data_split,
         username=username,
     )
+    if cursor is not None:
+        # keyset mode, returns the image right after the cursor
+        images = await db.get_images(
+            start=0 if cursor else index,
+            amount=1,
+            transform=entry2json,
+            after=decode_cursor(cursor),
+            **scope,
+        )
+    else:
+        image = await db.get_image(index=index, transform=entry2json, **scope)
+        images = [image] if image is not None else []
+
+    request.app["prefetcher"].served([image["image_id"] for image in images])
+    schedule_prefetch(
+        request, (username, tab, user_id), dict(scope, amount=batch_size), images
+    )
+    if cursor is None:
+        return web.json_response(images[0] if images else None)
+    if not images:
+        return web.json_response({"image": None, "cursor": cursor})
+    return web.json_response(
+        {"image": images[0], "cursor": encode_cursor(images[0]["image_id"])}
+    )
+
 
-    return web.json_response(image)
+def get_tab_filters(tab):
+    return TABS.get(tab, TABS["to_train"])
+
+
+def encode_cursor(image_id):
+    return base64.urlsafe_b64encode(str(image_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        raise web.HTTPBadRequest(text="Invalid cursor.")
 
 
 def entry2json(entry):
@@ -223,26 +594,19 @@ def entry2json(entry):
 async def get_random_images(request):
     session = await get_session(request)
     username = session.get("username", None)
+    db = request.app["db"]
 
     tab = request.query.get("tab", "to_verify")
     user_id = request.query.get("user_id", None)
 
-    if tab == "to_verify":
-        verified = 0
-        need_training = 0
-    elif tab == "verified":
-        verified = 1
-        need_training = 0
-    elif tab == "check":
-        verified = None
-        need_training = None
-    else:
-        verified = 0
-        need_training = 1
+    verified, need_training = get_tab_filters(tab)
 
     batch = int(request.query.get("batch", 1))
     batch_size = int(request.query.get("batch_size", 9))
     start = (batch - 1) * batch_size
+    cursor = request.query.get("cursor", None)
+    if cursor:
+        start = 0
 
     if username and username != "admin":
         data_split = get_user(username).get_data_split(db.size)
@@ -251,19 +615,48 @@ async def get_random_images(request):
     else:
         data_split = None
 
-    images = list(
-        db.get_images(
-            verified=verified,
-            need_training=need_training,
-            start=start,
-            transform=entry2json,
-            split=data_split,
-            username=username,
-            amount=batch_size,
-        )
+    # with `thumbnails=1` the thumbnails are embedded as data URIs, saving
+    # a round trip per image
+    embed = request.query.get("thumbnails") == "1"
+    image_paths = {}
+
+    def transform(entry):
+        image_paths[entry["image_id"]] = entry["image"]
+        return entry2json(entry)
+
+    scope = dict(
+        verified=verified,
+        need_training=need_training,
+        split=data_split,
+        username=username,
+        amount=batch_size,
     )
+    images = await db.get_images(
+        start=start,
+        transform=transform if embed else entry2json,
+        after=decode_cursor(cursor),
+        **scope,
+    )
+    request.app["prefetcher"].served([image["image_id"] for image in images])
+    size = thumbnail_size(request) if embed else None
+    schedule_prefetch(request, (username, tab, user_id), scope, images, size)
+
+    if embed:
+        found = await load_thumbnails(request, list(image_paths.items()), size)
+        content_type = db.thumbnails.codec.content_type
+        for image in images:
+            if image["image_id"] in found:
+                image["thumbnail_data"] = data_uri(
+                    content_type, found[image["image_id"]]
+                )
 
-    return web.json_response(images)
+    if cursor is None:
+        return web.json_response(images)
+
+    # keyset mode, the cursor points after the last image of the batch
+    if images:
+        cursor = encode_cursor(images[-1]["image_id"])
+    return web.json_response({"images": images, "cursor": cursor})
 
 
 @routes.get("/")
@@ -282,7 +675,7 @@ async def index(request):
         "tab": tab,
         "production": PRODUCTION,
         "user": session.get("username", None),
-        "total": db.size,
+        "total": request.app["db"].size,
         "user_list": annotators,
     }
     options.update(CONFIG)
@@ -297,7 +690,7 @@ async def handle_feedback(request):
         raise web.HTTPFound("/login")
 
     data = await request.json()
-    db.set_feedback(data["image_id"], data["qa_feedback"])
+    await request.app["db"].set_feedback(data["image_id"], data["qa_feedback"])
     return web.json_response({"status": "ok"})
 
 
@@ -315,10 +708,109 @@ async def get_feedback(request):
         if image_id.strip().isdigit()
     ]
 
-    feedback = db.get_feedback(image_ids)
+    feedback = await request.app["db"].get_feedback(image_ids)
     return web.json_response({"status": "ok", "feedback": feedback})
 
 
+def verdict_fields(action, caption, rejection_reasons, username):
+    fields = {"inclusive_alt_text": caption, "verified_by": username}
+    if action == "train":
+        fields["verified"] = 0
+        fields["need_training"] = 1
+        fields["rejection_reasons"] = rejection_reasons
+    else:
+        fields["need_training"] = 0
+        fields["verified"] = 1
+        fields["rejection_reasons"] = []
+    return fields
+
+
+def parse_verdict(verdict, username):
+    # image id and fields of one /verdicts item, ValueError when invalid
+    if not isinstance(verdict, dict):
+        raise ValueError("A verdict is an object")
+    image_id = verdict.get("image_id")
+    if isinstance(image_id, str) and image_id.isdigit():
+        image_id = int(image_id)
+    if not isinstance(image_id, int) or isinstance(image_id, bool):
+        raise ValueError("Invalid image_id")
+    action = verdict.get("action")
+    if action not in ("validate", "train"):
+        raise ValueError("action must be validate or train")
+    caption = verdict.get("caption", "")
+    if not isinstance(caption, str):
+        raise ValueError("caption must be a string")
+    reasons = verdict.get("rejection_reasons", [])
+    if not isinstance(reasons, list) or not all(isinstance(r, str) for r in reasons):
+        raise ValueError("rejection_reasons must be a list of strings")
+    return image_id, verdict_fields(action, caption, reasons, username)
+
+
+@routes.post("/verdicts")
+async def handle_verdicts(request):
+    # {"verdicts": [{"image_id", "action", "caption", "rejection_reasons"}]}
+    # applied all together in one transaction, or none of them when one
+    # is invalid. Answers the result of each verdict and the counters.
+    session = await get_session(request)
+    username = session.get("username")
+    if not username:
+        raise web.HTTPUnauthorized()
+    try:
+        verdicts = (await request.json())["verdicts"]
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text="Expected a JSON object with verdicts")
+    if not isinstance(verdicts, list) or not 0 < len(verdicts) <= MAX_VERDICTS:
+        raise web.HTTPBadRequest(text=f"Send between 1 and {MAX_VERDICTS} verdicts")
+
+    # image id of each verdict, None when it is invalid
+    image_ids = []
+    updates = {}
+    errors = {}
+    for i, verdict in enumerate(verdicts):
+        try:
+            image_id, fields = parse_verdict(verdict, username)
+        except ValueError as e:
+            image_ids.append(None)
+            errors[i] = str(e)
+            continue
+        image_ids.append(image_id)
+        if image_id in updates:
+            errors[i] = "Duplicate image_id"
+        else:
+            updates[image_id] = fields
+
+    db = request.app["db"]
+    if not errors:
+        missing = set(await db.update_images(updates))
+        errors = {
+            i: "Unknown image_id"
+            for i, image_id in enumerate(image_ids)
+            if image_id in missing
+        }
+
+    results = []
+    for i, image_id in enumerate(image_ids):
+        if i in errors:
+            result = {"ok": False, "error": errors[i]}
+        elif errors:
+            result = {"ok": False, "error": "Not applied"}
+        else:
+            result = {
+                "ok": True,
+                "verified": updates[image_id]["verified"],
+                "need_training": updates[image_id]["need_training"],
+            }
+        results.append({"image_id": image_id, **result})
+    return web.json_response(
+        {
+            "applied": not errors,
+            "results": results,
+            "counters": await compute_stats(db, username),
+        },
+        status=200 if not errors else 400,
+    )
+
+
 @routes.post("/train")
 async def handle_train(request):
     session = await get_session(request)
@@ -331,21 +823,18 @@ async def handle_train(request):
     image_id = int(data["image_id"])
 
     action = data.get("action", "discard")
-
-    fields = {"inclusive_alt_text": data.get("caption", ""), "verified_by": username}
-
+    fields = verdict_fields(
+        action,
+        data.get("caption", ""),
+        data.getall("rejection_reason", []),
+        username,
+    )
     if action == "train":
-        fields["verified"] = 0
-        fields["need_training"] = 1
-        fields["rejection_reasons"] = data.getall("rejection_reason", [])
         session["message"] = "Added for training."
     else:
-        fields["need_training"] = 0
-        fields["verified"] = 1
-        fields["rejection_reasons"] = []
         session["message"] = "Caption validated."
 
-    db.update_image(image_id, **fields)
+    await request.app["db"].update_image(image_id, **fields)
     tab = request.query.get("tab", "to_verify")
     batch = request.query.get("batch", 1)
     raise web.HTTPFound(f"/?tab={tab}&batch={batch}")
@@ -359,8 +848,7 @@ async def handle_upload(request):
 
     reader = await request.multipart()
     image_data = await reader.next()
-    pil_image = PILImage.open(BytesIO(await image_data.read()))
-    pil_image = pil_image.convert("RGB")
+    image_bytes = await image_data.read()
 
     form_data = {"nsfw": 0, "golden": 0}
 
@@ -375,8 +863,24 @@ async def handle_upload(request):
         else:
             form_data[name] = await field.text()
 
+    # decoded and stored with the dataset codec in the image pool, off the
+    # event loop
+    db = request.app["db"]
+    image_id = await db.next_image_id()
+    try:
+        image_path = await request.app["image_pool"].run(
+            encode_upload,
+            image_bytes,
+            str(image_id),
+            db.codec,
+            db.store,
+            db.thumbnails,
+        )
+    except (OSError, ValueError):
+        raise web.HTTPBadRequest(text="Invalid image")
+
     entry = {
-        "image": pil_image,
+        "image": image_path,
         "alt_text": form_data["alt_text"],
         "license": form_data["license"],
         "source": form_data["source"],
@@ -389,34 +893,371 @@ async def handle_upload(request):
         "nsfw": form_data.get("nsfw", False),
         "golden": form_data.get("golden", False),
     }
-    db.add_image(**entry)
+    await db.add_image(image_id=image_id, **entry)
     raise web.HTTPFound("/?tab=to_verify&batch=1")
 
 
+@routes.get("/image_pool")
+async def image_pool_stats(request):
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    return web.json_response(request.app["image_pool"].stats())
+
+
+@routes.get("/prefetch")
+async def prefetch_stats(request):
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    return web.json_response(request.app["prefetcher"].stats())
+
+
+@routes.get("/stats_cache")
+async def stats_cache_stats(request):
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    return web.json_response(request.app["stats_cache"].stats())
+
+
+def render_metrics(app):
+    db = app["db"]
+    data_dict = db.data_dict
+    pool = app["image_pool"]
+    pool_stats = pool.stats()
+    cache = data_dict.cache.info()
+    stats_cache = app["stats_cache"].stats()
+    events = app["events"].stats()
+    prefetch = app["prefetcher"].stats()
+    lines = [
+        *app["requests"].render(),
+        *data_dict.queries.render(),
+        *data_dict.commits.render(),
+        *pool.tasks.render(),
+        *sample(
+            "checkvite_image_pool_depth",
+            "gauge",
+            "Image pool tasks queued or running.",
+            pool_stats["depth"],
+        ),
+        *sample(
+            "checkvite_image_pool_rejected_total",
+            "counter",
+            "Image pool tasks refused because the queue was full.",
+            pool_stats["rejected"],
+        ),
+        *sample(
+            "checkvite_image_pool_timeouts_total",
+            "counter",
+            "Image pool tasks given up after the timeout.",
+            pool_stats["timeouts"],
+        ),
+        *sample("checkvite_images", "gauge", "Images in the dataset.", db.size),
+        *sample(
+            "checkvite_pending_writes",
+            "gauge",
+            "Changed entries not committed yet.",
+            len(data_dict.pending) + len(data_dict.flushing),
+        ),
+        *sample(
+            "checkvite_entry_cache_size",
+            "gauge",
+            "Entries in the cache of the lazy mode.",
+            cache["size"],
+        ),
+        *sample(
+            "checkvite_entry_cache_requests_total",
+            "counter",
+            "Entry cache lookups.",
+            {"hit": cache["hits"], "miss": cache["misses"]},
+            ("result",),
+        ),
+        *sample(
+            "checkvite_stats_cache_requests_total",
+            "counter",
+            "/stats requests by how they were answered.",
+            {
+                "hit": stats_cache["hits"],
+                "miss": stats_cache["misses"],
+                "not_modified": stats_cache["not_modified"],
+            },
+            ("result",),
+        ),
+        *sample(
+            "checkvite_event_clients",
+            "gauge",
+            "Open /events streams.",
+            events["clients"],
+        ),
+        *sample(
+            "checkvite_events_sent_total",
+            "counter",
+            "Events pushed to the /events streams.",
+            events["sent"],
+        ),
+        *sample(
+            "checkvite_event_clients_dropped_total",
+            "counter",
+            "/events streams closed for falling behind.",
+            events["dropped"],
+        ),
+        *sample(
+            "checkvite_prefetch_tasks_total",
+            "counter",
+            "Page prefetches by outcome.",
+            {
+                "completed": prefetch["completed"],
+                "failed": prefetch["failed"],
+                "skipped": prefetch["skipped"],
+            },
+            ("outcome",),
+        ),
+        *sample(
+            "checkvite_prefetch_served_total",
+            "counter",
+            "Served images, whether they had been prefetched.",
+            {"hit": prefetch["hits"], "miss": prefetch["misses"]},
+            ("result",),
+        ),
+    ]
+    return "\n".join(lines) + "\n"
+
+
+@routes.get("/metrics")
+async def metrics(request):
+    # Prometheus text format, the numbers are those of this process
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    return web.Response(
+        body=render_metrics(request.app).encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+def float_param(data, name, default, low, high):
+    try:
+        value = float(data.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"Invalid {name}")
+    if not low <= value <= high:
+        raise web.HTTPBadRequest(text=f"{name} must be between {low} and {high}")
+    return value
+
+
+@routes.get("/profiler")
+async def profiler_stats(request):
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    return web.json_response(request.app["profiler"].stats())
+
+
+@routes.post("/profiler")
+async def start_profiler(request):
+    # opens a profiling window of `seconds` over a `fraction` of the
+    # requests, or only those of `route` ("/get_images"...), sampled every
+    # `interval` seconds
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    data = await request.post()
+    seconds = float_param(data, "seconds", 30, 1, MAX_PROFILE_SECONDS)
+    fraction = float_param(data, "fraction", 1, 0.001, 1)
+    interval = float_param(data, "interval", 0.005, 0.001, 1)
+    route = data.get("route") or None
+    profiler = request.app["profiler"]
+    profiler.start(seconds, route, fraction, interval)
+    print(f"Profiling {route or 'all routes'} for {seconds}s")
+    return web.json_response(profiler.stats())
+
+
+@routes.post("/profiler/stop")
+async def stop_profiler(request):
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    profiler = request.app["profiler"]
+    profiler.stop()
+    return web.json_response(profiler.stats())
+
+
+@routes.get("/profiler/stacks")
+async def profiler_stacks(request):
+    # collapsed stacks, for flamegraph.pl, speedscope or inferno
+    session = await get_session(request)
+    if session.get("username") != "admin":
+        raise web.HTTPForbidden()
+    profiler = request.app["profiler"]
+    started = datetime.fromtimestamp(profiler.started or time.time())
+    filename = f"checkvite-{started:%Y%m%d-%H%M%S}.collapsed"
+    return web.Response(
+        text=profiler.collapsed(),
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 async def start_app(app):
-    app["data_saver"] = asyncio.create_task(db.sync())
+    app["data_saver"] = asyncio.create_task(app["db"].sync())
+    app["tasks"] = [app["data_saver"]]
+    if app["db"].shared:
+        app["tasks"].append(asyncio.create_task(app["db"].watch()))
+    app["events"].start(asyncio.get_running_loop(), app["db"])
+
+
+async def shutdown_app(app):
+    # ends the open event streams so the server does not wait on them
+    app["events"].stop()
+    app["profiler"].stop()
+    await app["prefetcher"].close()
 
 
 async def cleanup_app(app):
-    app["data_saver"].cancel()
-    db.save()
-    await app["data_saver"]
+    for task in app["tasks"]:
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+    # flush the pending writes
+    await app["db"].close()
+    app["image_pool"].shutdown()
+
+
+def create_database(shared=False):
+    return Database(
+        lazy=os.environ.get("CHECKVITE_LAZY", "1") == "1",
+        cache_size=int(os.environ.get("CHECKVITE_CACHE_SIZE", 10000)),
+        durability=os.environ.get("CHECKVITE_DURABILITY", "normal"),
+        thumbnail_sizes=CONFIG.get("thumbnail_sizes", [100]),
+        image_codec=CONFIG.get("image_codec", "png"),
+        shared=shared,
+    )
+
+
+def create_image_pool():
+    return ImagePool(
+        workers=int(os.environ.get("CHECKVITE_IMAGE_WORKERS", 2)),
+        max_queue=int(os.environ.get("CHECKVITE_IMAGE_QUEUE", 32)),
+        timeout=float(os.environ.get("CHECKVITE_IMAGE_TIMEOUT", 30)),
+    )
 
 
-app = web.Application()
-app.on_startup.append(start_app)
-app.on_cleanup.append(cleanup_app)
-setup(app, EncryptedCookieStorage(SECRET_KEY))
-app.add_routes(routes)
-app.add_routes(
-    [
-        web.static("/static", os.path.join(HERE, "static")),
+def create_app(database=None, secret_key=SECRET_KEY, image_pool=None):
+    app = web.Application(
+        middlewares=[metrics_middleware, profile_middleware, overload_middleware]
+    )
+    app["requests"] = Histogram(
+        "checkvite_http_request_seconds",
+        "Time to answer the requests, by route and status.",
+        ("method", "route", "status"),
+    )
+    app["db"] = AsyncDatabase(database or create_database())
+    app["image_pool"] = image_pool or create_image_pool()
+    app["stats_cache"] = StatsCache()
+    app["profiler"] = Profiler()
+    app["events"] = EventBroadcaster()
+    app["prefetcher"] = Prefetcher(
+        max_tasks=int(os.environ.get("CHECKVITE_PREFETCH_TASKS", 2))
+    )
+    app.on_startup.append(start_app)
+    app.on_shutdown.append(shutdown_app)
+    app.on_cleanup.append(cleanup_app)
+    app.on_response_prepare.append(set_image_validators)
+    setup(app, EncryptedCookieStorage(secret_key))
+    app.add_routes(routes)
+    app.add_routes(
+        [
+            web.static("/static", os.path.join(HERE, "static")),
+        ]
+    )
+    aiohttp_jinja2.setup(
+        app,
+        loader=jinja2.FileSystemLoader(os.path.join(HERE, "templates")),
+    )
+    return app
+
+
+def listen(production):
+    if not production:
+        return socket.create_server(("0.0.0.0", 8080))
+    path = os.path.join(os.path.dirname(__file__), "aiohttp.socket")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    return sock
+
+
+def cookie_key():
+    # read once, the workers must all decrypt the cookies the others set
+    key = os.environ.get("CHECKVITE_SECRET_KEY", SECRET_KEY)
+    try:
+        fernet.Fernet(key)
+    except ValueError:
+        raise SystemExit(
+            "The cookie key is not a Fernet key, set CHECKVITE_SECRET_KEY to "
+            "one made by cryptography.fernet.Fernet.generate_key()"
+        )
+    return key
+
+
+def run_worker(sock, production, secret_key):
+    global PRODUCTION
+    PRODUCTION = production
+    web.run_app(
+        create_app(create_database(shared=True), secret_key=secret_key), sock=sock
+    )
+
+
+def run_workers(count, production):
+    # the workers accept on the same socket, each with its own in-memory
+    # state over the shared SQLite file, kept coherent by the change log.
+    # The store is opened here first so imports and migrations run once.
+    secret_key = cookie_key()
+    db = create_database(shared=True)
+    db.save()
+    db.save_snapshot()
+    db.data_dict.conn.close()
+    sock = listen(production)
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(sock, production, secret_key))
+        for _ in range(count)
     ]
-)
-aiohttp_jinja2.setup(
-    app,
-    loader=jinja2.FileSystemLoader(os.path.join(HERE, "templates")),
-)
+    for worker in workers:
+        worker.start()
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    # a worker that dies takes the others down with it, so whatever
+    # supervises the server sees the failure and starts it again
+    failed = False
+    alive = list(workers)
+    while alive:
+        try:
+            multiprocessing.connection.wait([worker.sentinel for worker in alive])
+        except KeyboardInterrupt:
+            # Ctrl-C reaches the workers too, they stop on their own
+            stopping = True
+            continue
+        for worker in [worker for worker in alive if not worker.is_alive()]:
+            alive.remove(worker)
+            if worker.exitcode != 0 and not stopping:
+                print(
+                    f"Worker {worker.pid} exited with code {worker.exitcode}, "
+                    "stopping the others"
+                )
+                failed = True
+                stop()
+    if failed:
+        raise SystemExit(1)
 
 
 def main():
@@ -425,13 +1266,24 @@ def main():
     parser.add_argument(
         "--local", action="store_true", help="Set the mode to local.", default=False
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Serve from that many processes sharing the database.",
+    )
     args = parser.parse_args()
-    if args.local:
+    if args.workers > 1:
+        run_workers(args.workers, int(not args.local))
+    elif args.local:
         PRODUCTION = 0
-        web.run_app(app)
+        web.run_app(create_app(secret_key=cookie_key()))
     else:
         PRODUCTION = 1
-        web.run_app(app, path=os.path.join(os.path.dirname(__file__), "aiohttp.socket"))
+        web.run_app(
+            create_app(secret_key=cookie_key()),
+            path=os.path.join(os.path.dirname(__file__), "aiohttp.socket"),
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import threading
+from array import array
+
+# <magic><header size><JSON header><padding to 8 bytes><int64 arrays><keys>
+# The header tells where each array and the newline separated keys are,
+# relative to the start of the data.
+MAGIC = b"checkvite-index-1\n"
+
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+
+def write_snapshot(path, tokens, keys, indexes, counters):
+    # `indexes` is a list of (name, SortedIndex). Returns False when the
+    # state cannot be written this way.
+    if any("\n" in key for key in keys):
+        return False
+    blobs = []
+    offset = 0
+
+    def add(ids):
+        nonlocal offset
+        blob = array("q", ids).tobytes()
+        blobs.append(blob)
+        position = [offset, len(ids)]
+        offset += len(blob)
+        return position
+
+    try:
+        layout = [
+            {
+                "name": name,
+                "ids": add(index.ids),
+                "own": [[user, *add(ids)] for user, ids in index.own_uploads.items()],
+            }
+            for name, index in indexes
+        ]
+    except (TypeError, OverflowError):
+        return False
+    keys_blob = "\n".join(keys).encode()
+    header = json.dumps(
+        {
+            "tokens": tokens,
+            "byteorder": sys.byteorder,
+            "counters": counters,
+            "indexes": layout,
+            "keys": [offset, len(keys_blob), len(keys)],
+        }
+    ).encode()
+    start = len(MAGIC) + 4 + len(header)
+    temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        f.write(b"\0" * (_aligned(start) - start))
+        for blob in blobs:
+            f.write(blob)
+        f.write(keys_blob)
+    os.replace(temp_path, path)
+    return True
+
+
+def read_snapshot(path):
+    # None when there is no usable snapshot, the caller checks the tokens
+    try:
+        with open(path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as data:
+            if data[: len(MAGIC)] != MAGIC:
+                return None
+            (size,) = struct.unpack_from("<I", data, len(MAGIC))
+            start = len(MAGIC) + 4
+            header = json.loads(data[start : start + size])
+            if header["byteorder"] != sys.byteorder:
+                return None
+            base = _aligned(start + size)
+
+            def ints(offset, count):
+                ids = array("q")
+                ids.frombytes(data[base + offset : base + offset + count * 8])
+                return ids.tolist()
+
+            indexes = {
+                index["name"]: (
+                    ints(*index["ids"]),
+                    {user: ints(offset, count) for user, offset, count in index["own"]},
+                )
+                for index in header["indexes"]
+            }
+            offset, size, count = header["keys"]
+            keys = data[base + offset : base + offset + size].decode()
+            keys = keys.split("\n") if count else []
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+    if len(keys) != count:
+        return None
+    return {
+        "tokens": header["tokens"],
+        "counters": header["counters"],
+        "indexes": indexes,
+        "keys": keys,
+    }
@@ -39,6 +39,11 @@ export class ImageCaptionApp {
   #batchSize;
   #checkBatchSize;
   #userList;
+  #cursor;
+  // image ids with a verdict on its way, their own event is ignored
+  #submitting = new Set();
+  // the pending refill, the next one waits for it and its cursor
+  #refill = Promise.resolve();
 
   constructor() {
     this.#initializeEnvironment();
@@ -111,9 +116,46 @@ export class ImageCaptionApp {
       this.clearBlurOnTabContents();
     }
 
+    this.listenToEvents();
     await this.loadTab(this.#currentTab);
   }
 
+  listenToEvents() {
+    if (!window.EventSource) {
+      return;
+    }
+    const events = new EventSource("/events");
+    events.addEventListener("image", (event) => {
+      const { image_id, verified, need_training } = JSON.parse(event.data);
+      // somebody gave a verdict, the image is not to verify anymore
+      if (this.#currentTab !== "to_verify" || !(verified || need_training)) {
+        return;
+      }
+      if (this.#submitting.has(String(image_id))) {
+        return;
+      }
+      const img = document.getElementById(`actual_${image_id}`);
+      if (img && img.closest(".col-4")) {
+        img.closest(".col-4").remove();
+        this.reorganizeGrid(this.#currentBatch);
+      }
+    });
+    events.addEventListener("counters", (event) => {
+      if (this.#currentTab !== "stats") {
+        return;
+      }
+      const { verified, need_training, to_verify, total } = JSON.parse(
+        event.data,
+      );
+      document.getElementById("numberOfImages").textContent = `Total: ${total}`;
+      const chart = Chart.getChart("overallProgressChart");
+      if (chart) {
+        chart.data.datasets[0].data = [verified, need_training, to_verify];
+        chart.update();
+      }
+    });
+  }
+
   blurTabContents(message) {
     const tabContents = document.querySelectorAll(".tabcontent");
     tabContents.forEach((tab) => {
@@ -498,14 +540,24 @@ export class ImageCaptionApp {
       formData.append("action", submitButton.name);
     }
 
-    const response = await fetchURL("/train", {
-      method: "POST",
-      body: formData,
-    });
+    const imageId = String(formData.get("image_id"));
+    this.#submitting.add(imageId);
+    let response;
+    try {
+      response = await fetchURL("/train", {
+        method: "POST",
+        body: formData,
+      });
+    } finally {
+      this.#submitting.delete(imageId);
+    }
     if (response.ok) {
       if (this.#currentTab == "to_verify") {
-        form.closest(".col-4").remove();
-        this.reorganizeGrid(this.#currentBatch);
+        const block = form.closest(".col-4");
+        if (block && block.isConnected) {
+          block.remove();
+          this.reorganizeGrid(this.#currentBatch);
+        }
       } else {
         // In-place editing
         await this.loadTab(this.#currentTab);
@@ -534,13 +586,26 @@ export class ImageCaptionApp {
     }
   }
 
-  async fetchNewImage(batch, tab) {
+  fetchNewImage(batch, tab) {
+    // one refill at a time, each continues from the cursor of the last
+    this.#refill = this.#refill.then(() => this.#fetchNewImage(batch, tab));
+    return this.#refill;
+  }
+
+  async #fetchNewImage(batch, tab) {
     try {
       const response = await fetchURL(
-        `/get_image?batch=${batch}&index=8&tab=${tab}`,
+        `/get_image?batch=${batch}&index=8&tab=${tab}&cursor=${encodeURIComponent(this.#cursor ?? "")}`,
       );
       if (response.ok) {
-        const newImageData = await response.json();
+        const { image: newImageData, cursor } = await response.json();
+        this.#cursor = cursor;
+        if (
+          newImageData === null ||
+          document.getElementById(`actual_${newImageData.image_id}`)
+        ) {
+          return;
+        }
 
         const container = document.getElementById("images");
         const newImageBlock = this.createImageBlock(newImageData, 9, tab);
@@ -602,9 +667,10 @@ export class ImageCaptionApp {
 
   async fetchImages() {
     const response = await fetchURL(
-      `/get_images?batch=${this.#currentBatch}&tab=${this.#currentTab}`,
+      `/get_images?batch=${this.#currentBatch}&tab=${this.#currentTab}&cursor=`,
     );
-    const data = await response.json();
+    const { images: data, cursor } = await response.json();
+    this.#cursor = cursor;
     const oldContainer = document.getElementById("images");
 
     if (data.length === 0) {
@@ -825,7 +891,7 @@ export class ImageCaptionApp {
     }
     try {
       const response = await fetchURL(
-        `/get_images?batch=${this.#currentBatch}&batch_size=${this.#checkBatchSize}&tab=check&user_id=${this.#checkUser}`,
+        `/get_images?batch=${this.#currentBatch}&batch_size=${this.#checkBatchSize}&tab=check&user_id=${this.#checkUser}&thumbnails=1`,
       );
       const data = await response.json();
 
@@ -945,7 +1011,8 @@ export class ImageCaptionApp {
           if (key === "image_thumbnail_url") {
             // If the data is the image URL, create an img element
             const img = document.createElement("img");
-            img.src = `/images/thumbnail/${image.image_id}.png`;
+            img.src =
+              image.thumbnail_data ?? `/images/thumbnail/${image.image_id}.png`;
             img.alt = image.alt_text;
             img.className = "image";
             img.id = `thumbnail_${image.image_id}`;
@@ -0,0 +1,180 @@
+import os
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from checkvite.imagecodec import CODECS, get_codec
+
+
+class ThumbnailStore:
+    # thumbnails live next to the image directory, one directory per size:
+    # thumbnails/<size>/<image_id>.<ext>, encoded with the dataset codec. A
+    # thumbnail older than its source image is stale and rendered again.
+    def __init__(self, image_dir, sizes=(100,), thumbnail_dir=None, codec=None):
+        self.sizes = tuple(sizes)
+        self.codec = codec or get_codec("png")
+        self.thumbnail_dir = thumbnail_dir or os.path.join(
+            os.path.dirname(os.path.abspath(image_dir)), "thumbnails"
+        )
+        for size in self.sizes:
+            os.makedirs(os.path.join(self.thumbnail_dir, str(size)), exist_ok=True)
+
+    def path(self, image_id, size):
+        return os.path.join(
+            self.thumbnail_dir, str(size), f"{image_id}{self.codec.extension}"
+        )
+
+    def is_fresh(self, image_id, size, image_path):
+        try:
+            thumbnail = os.stat(self.path(image_id, size))
+        except FileNotFoundError:
+            return False
+        try:
+            return thumbnail.st_mtime_ns >= os.stat(image_path).st_mtime_ns
+        except FileNotFoundError:
+            return True
+
+    def render(self, image_id, image_path, image=None, sizes=None):
+        from PIL import Image
+
+        if image is None:
+            with Image.open(image_path) as source:
+                return self.render(image_id, image_path, source, sizes)
+        for size in sizes or self.sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), resample=Image.LANCZOS)
+            # written aside and renamed so readers never see a partial file
+            path = self.path(image_id, size)
+            temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            self.codec.encode(thumbnail, temp_path)
+            os.replace(temp_path, path)
+
+    def get(self, image_id, size, image_path):
+        if not self.is_fresh(image_id, size, image_path):
+            self.render(image_id, image_path, sizes=[size])
+        return self.path(image_id, size)
+
+    def read(self, image_id, size, image_path):
+        # the thumbnail bytes, None when it is missing or stale
+        if not self.is_fresh(image_id, size, image_path):
+            return None
+        try:
+            with open(self.path(image_id, size), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def read_many(self, images, size, render=False):
+        # image_id -> thumbnail bytes for (image_id, image_path) pairs, the
+        # stale ones are rendered when `render` is set, or left out
+        found = {}
+        for image_id, image_path in images:
+            if not isinstance(image_path, str):
+                continue
+            data = self.read(image_id, size, image_path)
+            if data is None and render:
+                try:
+                    self.get(image_id, size, image_path)
+                except (OSError, ValueError):
+                    continue
+                data = self.read(image_id, size, image_path)
+            if data is not None:
+                found[image_id] = data
+        return found
+
+    def warm(self, images, size):
+        # renders the missing and stale thumbnails of (image_id, image_path)
+        # pairs ahead of the requests, returns how many were rendered
+        rendered = 0
+        for image_id, image_path in images:
+            if not isinstance(image_path, str):
+                continue
+            if self.is_fresh(image_id, size, image_path):
+                continue
+            try:
+                self.render(image_id, image_path, sizes=[size])
+            except (OSError, ValueError):
+                continue
+            rendered += 1
+        return rendered
+
+    def invalidate(self, image_id):
+        # also drops the thumbnails left by a previous codec
+        for size in self.sizes:
+            for _, extension, _ in CODECS.values():
+                try:
+                    os.remove(
+                        os.path.join(
+                            self.thumbnail_dir, str(size), f"{image_id}{extension}"
+                        )
+                    )
+                except FileNotFoundError:
+                    pass
+
+    def stale(self, image_id, image_path):
+        return [
+            size for size in self.sizes if not self.is_fresh(image_id, size, image_path)
+        ]
+
+
+def _backfill_one(job):
+    store, image_id, image_path, sizes = job
+    try:
+        store.render(image_id, image_path, sizes=sizes)
+    except (OSError, ValueError) as e:
+        return f"{image_id}: {e}"
+    return None
+
+
+def backfill(data_dict, store, workers=None, force=False):
+    # renders the missing and stale thumbnails of every stored entry
+    from tqdm import tqdm
+
+    jobs = []
+    for key, entry in data_dict.items():
+        image_path = entry.get("image")
+        if not isinstance(image_path, str) or not os.path.exists(image_path):
+            continue
+        sizes = store.sizes if force else store.stale(key, image_path)
+        if sizes:
+            jobs.append((store, key, image_path, sizes))
+    errors = []
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(_backfill_one, jobs, chunksize=32)
+        for error in tqdm(results, total=len(jobs), desc="Rendering thumbnails"):
+            if error is not None:
+                errors.append(error)
+    return len(jobs), errors
+
+
+def main():
+    from checkvite.db import PersistentOrderedDict
+    from checkvite.serve import CONFIG
+
+    parser = argparse.ArgumentParser(
+        description="Render the missing and stale thumbnails."
+    )
+    parser.add_argument("--filename", default="alt-text")
+    parser.add_argument("--image-dir", default="images")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--force", action="store_true", help="Render every thumbnail again."
+    )
+    args = parser.parse_args()
+
+    data_dict = PersistentOrderedDict(
+        args.filename, image_dir=args.image_dir, read_only=True, lazy=True
+    )
+    store = ThumbnailStore(
+        args.image_dir,
+        CONFIG.get("thumbnail_sizes", [100]),
+        codec=get_codec(CONFIG.get("image_codec", "png")),
+    )
+    rendered, errors = backfill(data_dict, store, args.workers, args.force)
+    for error in errors:
+        print(f"Failed to render {error}")
+    print(f"Rendered thumbnails for {rendered - len(errors)} images")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,10 @@ setup(
     entry_points={
         "console_scripts": [
             "checkvite-web=checkvite.serve:main",
+            "checkvite-bench=checkvite.bench:main",
+            "checkvite-loadtest=checkvite.loadtest:main",
+            "checkvite-thumbnails=checkvite.thumbnails:main",
+            "checkvite-migrate-images=checkvite.imagecodec:main",
         ],
     },
 )